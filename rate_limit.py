@@ -0,0 +1,73 @@
+"""Guards for calls to a quota-limited upstream: a token bucket and a circuit breaker"""
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """Refills rate tokens per period; acquire(n) waits until n tokens are available
+
+    Waiters are served in arrival order, so a burst queues smoothly at the quota
+    instead of failing with 429s and retrying blindly.
+    """
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.capacity = rate
+        self._fill_rate = rate / period
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        # A request larger than the whole bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._fill_rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self._fill_rate)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that has been failing"""
+
+
+class CircuitBreaker:
+    """Fails fast after fail_max consecutive failures
+
+    Once open, one trial call is let through every reset_timeout seconds (half-open);
+    its success closes the circuit again.
+    """
+
+    def __init__(self, name: str, fail_max: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self):
+        if self._opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self._opened_at < self.reset_timeout:
+            raise CircuitOpenError(f"{self.name} is failing, next attempt in {self.reset_timeout - (now - self._opened_at):.0f}s")
+        # Re-arm the timer so only this caller makes the trial call
+        self._opened_at = now
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self.fail_max:
+            self._opened_at = time.monotonic()
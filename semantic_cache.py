@@ -0,0 +1,58 @@
+"""Embedding-similarity cache for near-duplicate Gemini requests"""
+import math
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    """Scale to unit length so cosine similarity is a plain dot product"""
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticCache:
+    """In-process LRU of (embedding, value) pairs
+
+    Entries are grouped by an exact-match bucket (e.g. language and grade level),
+    so a lookup only scans the handful of vectors that could legitimately match.
+    """
+
+    def __init__(self, threshold: float = 0.92, max_buckets: int = 128, max_per_bucket: int = 32):
+        self.threshold = threshold
+        self.max_buckets = max_buckets
+        self.max_per_bucket = max_per_bucket
+        self._buckets: "OrderedDict[Hashable, List[Tuple[List[float], Any]]]" = OrderedDict()
+
+    def lookup(self, bucket: Hashable, vector: List[float]) -> Optional[Any]:
+        """Return the closest cached value above the similarity threshold, if any"""
+        entries = self._buckets.get(bucket)
+        if not entries:
+            return None
+        vector = _normalize(vector)
+        best_index, best_score = None, self.threshold
+        for i, (cached_vector, _) in enumerate(entries):
+            score = sum(a * b for a, b in zip(vector, cached_vector))
+            if score >= best_score:
+                best_index, best_score = i, score
+        if best_index is None:
+            return None
+        self._buckets.move_to_end(bucket)
+        # Keep the bucket list in recency order too (most recent last)
+        entries.append(entries.pop(best_index))
+        return entries[-1][1]
+
+    def add(self, bucket: Hashable, vector: List[float], value: Any):
+        """Store a value under its embedding, evicting the least recently used entries"""
+        entries = self._buckets.setdefault(bucket, [])
+        self._buckets.move_to_end(bucket)
+        entries.append((_normalize(vector), value))
+        if len(entries) > self.max_per_bucket:
+            del entries[0]
+        if len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+
+    def __contains__(self, bucket: Hashable) -> bool:
+        return bool(self._buckets.get(bucket))
+
+    def clear(self):
+        self._buckets.clear()
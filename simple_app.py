@@ -1,14 +1,32 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, model_validator
+from typing import Annotated, AsyncIterator, Callable, List, Dict, Any, Literal, Optional, Tuple, Type
+import asyncio
+import atexit
+import functools
+import hashlib
+import importlib.util
 import os
-import json
+import orjson
+import logging
+import logging.handlers
+import queue
 import random
-import google.generativeai as genai
+import time
+import httpx
+from contextlib import asynccontextmanager
+from google import genai
+from google.genai import errors, types
 from dotenv import load_dotenv
+from cache import SingleFlight, TTLCache
+from rate_limit import CircuitBreaker, CircuitOpenError, TokenBucket
+from semantic_cache import SemanticCache
 
 # Load environment variables from .env file (only if file exists)
 try:
@@ -16,129 +34,368 @@ try:
 except:
     pass  # .env file doesn't exist in Vercel, that's fine
 
-# Configure Gemini API - check both possible environment variable names
-api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-if api_key:
-    genai.configure(api_key=api_key)
+# Configure Gemini API - check both possible environment variable names.
+# The environment is fixed for the life of the process, so resolve it once here.
+API_KEY = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+DEBUG = bool(os.getenv("DEBUG"))
+
+# Per-endpoint model choice: the chat loop (question + student replies) is
+# latency-critical, evaluation can be pointed at a deeper model if needed
+DEFAULT_MODEL = "gemini-2.5-flash"
+CHAT_MODEL = os.getenv("TEACHWISE_CHAT_MODEL", DEFAULT_MODEL)
+EVAL_MODEL = os.getenv("TEACHWISE_EVAL_MODEL", DEFAULT_MODEL)
+# Scenarios are drafted on the fast model and only regenerated here when the draft
+# fails a structural check; set TEACHWISE_FALLBACK_MODEL="" to never escalate
+FALLBACK_MODEL = os.getenv("TEACHWISE_FALLBACK_MODEL", "gemini-2.5-pro")
+
+# Per-endpoint (answer token budget, temperature). Gemini 2.5 counts thinking against
+# max_output_tokens, so thinking gets its own fixed budget on top; 512 is valid for the
+# flash, flash-lite and pro models alike.
+GENERATION_SETTINGS = {
+    "question": (512, 0.9),
+    "scenario": (1024, 0.7),
+    "session": (2048, 0.7),
+    "student": (256, 0.9),
+    "evaluation": (1500, 0.3),
+}
+THINKING_BUDGET = 512
+
+# Explicit context caching of the static system instructions. Opt-in, since Gemini
+# only caches prompts above a minimum token count; smaller ones are sent inline.
+PROMPT_CACHE_ENABLED = bool(os.getenv("TEACHWISE_PROMPT_CACHE"))
+PROMPT_CACHE_TTL = 3600
+
+# Multiplex Gemini calls over HTTP/2 when the h2 extra is installed (httpx[http2])
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None
+GEMINI_KEEPALIVE_EXPIRY = 300
+
+# Proactive pacing under the Gemini project quota, per process (split it across
+# WEB_CONCURRENCY workers). Unset or 0 means no client-side limit.
+GEMINI_RPM = int(os.getenv("TEACHWISE_GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("TEACHWISE_GEMINI_TPM", "0"))
+
+# Each Gemini attempt is bounded, transient failures (429/5xx) are retried with backoff
+# by the SDK, and after repeated failures calls fail fast until Gemini recovers
+GEMINI_TIMEOUT = float(os.getenv("TEACHWISE_GEMINI_TIMEOUT", "25"))
+GEMINI_RETRY = types.HttpRetryOptions(
+    attempts=3,
+    initial_delay=0.2,
+    max_delay=2,
+    http_status_codes=[408, 429, 500, 502, 503, 504]
+)
+BREAKER_FAIL_MAX = 5
+BREAKER_RESET_TIMEOUT = 30
+
+# Near-duplicate question/scenario requests are answered from an embedding-similarity cache
+SEMANTIC_CACHE_ENABLED = os.getenv("TEACHWISE_SEMANTIC_CACHE", "1") != "0"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+EMBED_MODEL = "gemini-embedding-001"
+
+# Open the Gemini connection at startup (DNS, TLS, auth) so the first user request doesn't pay for it
+WARMUP_ENABLED = os.getenv("TEACHWISE_WARMUP", "1") != "0"
+
+# Per-request detail goes through logging so production can silence it (e.g. LOG_LEVEL=WARNING)
+logger = logging.getLogger("teachwise")
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or ("DEBUG" if DEBUG else "INFO")).upper()
+# A typo here must not take the whole app down at import
+LOG_LEVEL_VALID = LOG_LEVEL in ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG")
+logger.setLevel(LOG_LEVEL if LOG_LEVEL_VALID else "INFO")
+_log_listener = None
+if not logger.handlers:
+    if os.getenv("VERCEL"):
+        # Serverless instances are frozen after each response, so write synchronously
+        logger.addHandler(logging.StreamHandler())
+    else:
+        # Hand records to a background thread so the event loop never blocks on stderr
+        _log_queue = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+        _log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+if not LOG_LEVEL_VALID:
+    logger.warning("⚠️ Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+if API_KEY:
     print("🚀 Gemini API initialized successfully")
 else:
     print("⚠️  Warning: GOOGLE_API_KEY not found. AI features will be disabled.")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the shared Gemini client at startup and release its pool on shutdown"""
+    # Pay the client's construction cost before the first request rather than during it
+    warmup = None
+    if gemini_service.available:
+        gemini_service._get_client()
+        if WARMUP_ENABLED:
+            # In the background, so a slow or unreachable Gemini never holds up startup
+            warmup = asyncio.create_task(gemini_service.warmup())
+    yield
+    if warmup:
+        warmup.cancel()
+    await gemini_service.aclose()
+
 app = FastAPI(
     title="TeachWise - Simple AI Teaching Simulator",
     description="Streamlined AI-powered teaching practice platform",
-    version="2.0"
+    version="2.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# Add CORS middleware
+# Request bodies are bounded in size and read time so a slow or oversized upload
+# can't tie up the handler (chat histories stay far below 1 MiB)
+MAX_BODY_BYTES = 1 << 20
+BODY_READ_TIMEOUT = 10.0
+
+class LimitedBodyRequest(Request):
+    """Request whose body read enforces MAX_BODY_BYTES and BODY_READ_TIMEOUT"""
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            declared = self.headers.get("content-length")
+            if declared is not None:
+                try:
+                    declared_size = int(declared)
+                except ValueError:
+                    raise HTTPException(status_code=400, detail="Invalid Content-Length header")
+                if declared_size > MAX_BODY_BYTES:
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            try:
+                self._body = await asyncio.wait_for(self._read_limited_body(), BODY_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=408, detail="Timed out reading request body")
+        return self._body
+
+    async def _read_limited_body(self) -> bytes:
+        chunks = []
+        received = 0
+        async for chunk in self.stream():
+            received += len(chunk)
+            if received > MAX_BODY_BYTES:
+                raise HTTPException(status_code=413, detail="Request body too large")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+class LimitedBodyRoute(APIRoute):
+    """Route class that hands handlers a LimitedBodyRequest"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # json_body() reads the body itself, so FastAPI can't see it; document it for /docs
+        self.body_model = next((getattr(d.call, "body_model") for d in self.dependant.dependencies if hasattr(d.call, "body_model")), None)
+        if self.body_model is not None:
+            self.openapi_extra = {
+                "requestBody": {
+                    "required": True,
+                    "content": {"application/json": {"schema": {"$ref": f"#/components/schemas/{self.body_model.__name__}"}}}
+                },
+                **(self.openapi_extra or {})
+            }
+
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def custom_route_handler(request: Request) -> Response:
+            return await original_route_handler(LimitedBodyRequest(request.scope, request.receive))
+
+        return custom_route_handler
+
+app.router.route_class = LimitedBodyRoute
+
+# Add CORS middleware - a fixed origin/method/header set lets Starlette build the
+# CORS headers once at startup instead of echoing request headers on every call
+CORS_ORIGINS = ["*"]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type"],
 )
 
+# Compress JSON bodies and the frontend; Starlette leaves text/event-stream alone so the
+# student stream isn't buffered. Vercel's edge already compresses, so skip the work there.
+if not os.getenv("VERCEL"):
+    app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
 # Pydantic models
-class StudentPersona(BaseModel):
-    conceptual_readiness: int = 5  # 1-10, prior knowledge strength
-    metacognitive_awareness: int = 5  # 1-10, ability to self-monitor understanding  
-    persistence: int = 5  # 1-10, willingness to work through difficulty
-    communication_style: str = "verbal"  # "verbal", "visual", "hands_on"
-    confidence_level: int = 5  # 1-10, affects willingness to share thinking
-
-class ScenarioRequest(BaseModel):
-    gradeLevel: str
-    subject: str
-    learningOutcomes: str
-    concepts: str
-    question: Optional[str] = None  # Add question parameter
+class RequestModel(BaseModel):
+    # Parsed requests are read-only, which also makes them hashable cache keys
+    model_config = ConfigDict(frozen=True)
+
+# Length caps on what the browser sends; anything longer is a 422 before it reaches a prompt
+Label = Annotated[str, Field(max_length=200)]
+Text = Annotated[str, Field(max_length=8192)]
+
+class StudentPersona(RequestModel):
+    # Range checks run in pydantic-core, so the prompt code can index the 1-10 guides directly
+    conceptual_readiness: int = Field(5, ge=1, le=10)  # prior knowledge strength
+    metacognitive_awareness: int = Field(5, ge=1, le=10)  # ability to self-monitor understanding
+    persistence: int = Field(5, ge=1, le=10)  # willingness to work through difficulty
+    communication_style: Literal["verbal", "visual", "hands_on"] = "verbal"
+    confidence_level: int = Field(5, ge=1, le=10)  # affects willingness to share thinking
+
+class Student(RequestModel):
+    name: str = "a student"
+    background: str = ""
+    performanceLevel: str = "average"
+    actualMisconception: str = ""
+    initialResponse: str = ""
+
+class Scenario(RequestModel):
+    # As returned by /api/generate-scenario; extra fields the frontend adds are ignored
+    student: Student = Student()
+    misconceptionOptions: List[str] = []
+    correctMisconceptionIndex: int = 0
+    topic: str = "this subject"
+    difficulty: str = "intermediate"
+    persona: StudentPersona = StudentPersona()
+    practiceQuestion: str = ""
+
+class ChatMessage(RequestModel):
+    sender: Literal["teacher", "student", "system"]
+    message: Text
+
+class ScenarioRequest(RequestModel):
+    gradeLevel: Label
+    subject: Label
+    learningOutcomes: Text
+    concepts: Text
+    question: Optional[Text] = None  # Add question parameter
     studentPersona: StudentPersona = StudentPersona()
-    language: str = "english"  # Add language parameter
+    language: Label = "english"  # Add language parameter
 
-class StudentResponseRequest(BaseModel):
-    scenario: Dict[str, Any]
-    teacherMessage: str
-    chatHistory: List[Dict[str, str]]
-    language: str = "english"  # Add language parameter
+class StudentResponseRequest(RequestModel):
+    scenario: Scenario
+    teacherMessage: Text
+    chatHistory: List[ChatMessage]
+    language: Label = "english"  # Add language parameter
 
-class EvaluationRequest(BaseModel):
-    scenario: Dict[str, Any]
+class EvaluationRequest(RequestModel):
+    scenario: Scenario
     selectedMisconception: int
-    intervention: str
-    chatHistory: List[Dict[str, str]]
-    selectedStrategy: Optional[str] = None  # Add strategy parameter
-    language: str = "english"  # Add language parameter
-
-class QuestionGenerationRequest(BaseModel):
-    gradeLevel: str
-    subject: str
-    learningOutcomes: str
-    concepts: str
-    language: str = "english"  # Add language parameter
+    intervention: Text
+    chatHistory: List[ChatMessage]
+    selectedStrategy: Optional[Text] = None  # Add strategy parameter
+    language: Label = "english"  # Add language parameter
 
-# Gemini AI service
-class GeminiService:
-    def __init__(self):
-        self.model = None
-        self._initialize_model()
-    
-    def _initialize_model(self):
-        """Initialize the Gemini model only when needed"""
+    @model_validator(mode="after")
+    def _check_selection(self) -> "EvaluationRequest":
+        # The index is used to look up the diagnosis text, so it must point at a real option
+        if not 0 <= self.selectedMisconception < len(self.scenario.misconceptionOptions):
+            raise ValueError("selectedMisconception must index one of scenario.misconceptionOptions")
+        return self
+
+class SessionRequest(RequestModel):
+    gradeLevel: Label
+    subject: Label
+    learningOutcomes: Text
+    concepts: Text
+    studentPersona: StudentPersona = StudentPersona()
+    language: Label = "english"
+
+class QuestionGenerationRequest(RequestModel):
+    gradeLevel: Label
+    subject: Label
+    learningOutcomes: Text
+    concepts: Text
+    language: Label = "english"  # Add language parameter
+
+def json_body(model: Type[BaseModel]) -> Any:
+    """Dependency validating the raw body in a single pass with pydantic-core's JSON parser
+
+    FastAPI's default decodes to a dict first and validates that afterwards.
+    """
+    async def parse(request: Request) -> BaseModel:
         try:
-            api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-            print(f"🔍 DEBUG: Checking API key - present: {bool(api_key)}, length: {len(api_key) if api_key else 0}")
-            
-            if api_key:
-                # Ensure genai is configured with the API key
-                try:
-                    genai.configure(api_key=api_key)
-                    print("✅ DEBUG: genai.configure() called successfully")
-                except Exception as config_error:
-                    print(f"❌ DEBUG: Failed to configure genai: {config_error}")
-                    raise
-                
-                # Use gemini-2.5-flash as the primary model with fallbacks
-                model_names = ['gemini-2.5-flash', 'gemini-2.0-flash-exp', 'gemini-1.5-flash', 'gemini-1.5-pro']
-                
-                last_error = None
-                for model_name in model_names:
-                    try:
-                        print(f"🔍 DEBUG: Attempting to initialize {model_name}...")
-                        self.model = genai.GenerativeModel(model_name)
-                        # Test the model is actually working
-                        print(f"🚀 Gemini API model initialized successfully with {model_name}")
-                        return
-                    except Exception as model_error:
-                        print(f"⚠️  Failed to initialize {model_name}: {str(model_error)}")
-                        last_error = model_error
-                        continue
-                
-                # If all models fail, log detailed error
-                error_msg = f"Could not initialize any Gemini model. Last error: {last_error}"
-                print(f"❌ DEBUG: {error_msg}")
-                raise Exception(error_msg)
-            else:
-                print("⚠️  Gemini API not initialized - no API key found")
-                print(f"🔍 DEBUG: GOOGLE_API_KEY={os.getenv('GOOGLE_API_KEY')}, GEMINI_API_KEY={os.getenv('GEMINI_API_KEY')}")
-        except Exception as e:
-            print(f"❌ Error initializing Gemini API: {e}")
-            import traceback
-            print(f"❌ DEBUG: Full traceback:\n{traceback.format_exc()}")
-            self.model = None
-    
-    def _check_api_available(self):
-        """Check if API is available before making calls"""
-        if not self.model:
-            raise HTTPException(
-                status_code=503, 
-                detail="AI service unavailable. Please check your GOOGLE_API_KEY environment variable."
-            )
-    
-    def _get_language_prefix(self, language: str) -> str:
-        """Get language-specific prompt prefix"""
-        if language == "traditional_chinese":
-            return """
+            return model.model_validate_json(await request.body())
+        except ValidationError as e:
+            # Same 422 shape FastAPI produces for body parameters
+            raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)])
+    parse.body_model = model
+    return Depends(parse)
+
+def openapi_with_bodies() -> Dict[str, Any]:
+    """FastAPI's schema plus the json_body() models the route operations reference"""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        components = schema.setdefault("components", {}).setdefault("schemas", {})
+        for route in app.routes:
+            model = getattr(route, "body_model", None)
+            if model is not None:
+                model_schema = model.model_json_schema(ref_template="#/components/schemas/{model}")
+                components.update(model_schema.pop("$defs", {}))
+                components[model.__name__] = model_schema
+    return app.openapi_schema
+
+app.openapi = openapi_with_bodies
+
+# Response schemas for Gemini's structured output mode
+class QuestionOut(BaseModel):
+    question: str
+    rationale: str
+    expectedMisconceptions: List[str]
+
+class StudentOut(BaseModel):
+    name: str
+    background: str
+    performanceLevel: str
+    actualMisconception: str
+    initialResponse: str
+
+class ScenarioOut(BaseModel):
+    student: StudentOut
+    misconceptionOptions: List[str]
+    correctMisconceptionIndex: int
+    topic: str
+    difficulty: str
+
+class SessionOut(BaseModel):
+    # Question fields first: Gemini emits properties in schema order, and the student answers the question
+    question: str
+    rationale: str
+    expectedMisconceptions: List[str]
+    student: StudentOut
+    misconceptionOptions: List[str]
+    correctMisconceptionIndex: int
+    topic: str
+    difficulty: str
+
+class EvaluationOut(BaseModel):
+    score: int
+    questioningScore: int
+    correctMisconception: str
+    feedback: str
+    improvements: List[str]
+
+# Roleplay guidance for each communication style
+COMM_GUIDANCE = {
+    "visual": "Ask for diagrams/pictures, describe spatial relationships",
+    "hands_on": "Want to try things, mention physical examples",
+    "verbal": "Prefer verbal explanations, ask for definitions",
+}
+COMM_GUIDANCE_ZH = {
+    "visual": "要求圖表/圖片，描述空間關係",
+    "hands_on": "想要嘗試事物，提及實際例子",
+    "verbal": "偏好口語解釋，詢問定義",
+}
+
+def _level_guide(low: str, mid: str, high: str) -> Dict[int, str]:
+    """Guidance per 1-10 trait level: low for 1-3, high for 8-10"""
+    return {level: low if level <= 3 else high if level >= 8 else mid for level in range(1, 11)}
+
+# Behavioral guidance for each persona trait level, built once at import
+CONFIDENCE_GUIDE = _level_guide("Be hesitant, use 'maybe', 'I think', ask for validation", "Show moderate confidence", "Be assertive and state opinions clearly")
+PERSISTENCE_GUIDE = _level_guide("Give up quickly, say 'I don't know' often", "Show average persistence", "Keep trying, ask follow-up questions")
+METACOG_GUIDE = _level_guide("Don't recognize own mistakes or confusion", "Show moderate metacognitive awareness", "Say things like 'I'm confused about...' or 'I think I understand but...'")
+CONFIDENCE_GUIDE_ZH = _level_guide("猶豫不決，使用「可能」、「我想」，尋求確認", "表現中等信心", "自信並清楚表達意見")
+PERSISTENCE_GUIDE_ZH = _level_guide("容易放棄，經常說「我不知道」", "表現平均堅持度", "持續嘗試，提出後續問題")
+METACOG_GUIDE_ZH = _level_guide("不認識自己的錯誤或困惑", "表現中等後設認知意識", "會說「我對...感到困惑」或「我想我明白但是...」")
+
+# Prompt text, built once at import. The *_INSTRUCTIONS are static and sent as the
+# system instruction (a shared, cacheable prefix); the *_PROMPTS are formatted per request.
+def _localized(table: Dict[str, Any], language: str) -> Any:
+    """Pick the entry for the language, falling back to English"""
+    return table.get(language, table["english"])
+
+LANGUAGE_PREFIX_ZH = """
             **[繁體中文模式]** 你扮演一位AI教學助手，你必須以繁體中文回答所有問題。
             
             重要指示：
@@ -148,119 +405,54 @@ class GeminiService:
             4. 確保所有回覆都是繁體中文
             
             """
-        return ""  # Default to English (no prefix needed)
-    
-    def _clean_json_response(self, text: str) -> str:
-        """Clean JSON response by removing markdown code blocks"""
-        # Remove ```json and ``` if present
-        text = text.strip()
-        if text.startswith('```json'):
-            text = text[7:]  # Remove ```json
-        elif text.startswith('```'):
-            text = text[3:]   # Remove ```
-        
-        if text.endswith('```'):
-            text = text[:-3]  # Remove closing ```
-        
-        return text.strip()
-    
-    def generate_question(self, grade_level: str, subject: str, learning_outcomes: str, concepts: str, language: str = "english") -> Dict[str, Any]:
-        """Generate a practice question based on learning outcomes and concepts"""
-        
-        self._check_api_available()
-        
-        language_prefix = self._get_language_prefix(language)
-        
-        # Translate labels based on language
-        if language == "traditional_chinese":
-            question_template = """
-            為 {grade_level} {subject} 課程生成一個高質量的練習問題。
-            
-            學習成果：{learning_outcomes}
-            關鍵概念：{concepts}
-            
-            創建一個問題，要求：
-            1. 是開放式的，鼓勵學生思考
-            2. 允許多種方法或解釋
-            3. 可以揭示關於概念的常見誤解
-            4. 適合 {grade_level} 年級水平
-            5. 與指定的學習成果相關
-            
-            問題應該設計來幫助教師診斷學生理解並識別誤解。
-            
-            以這個JSON格式回覆：
-            {{
-                "question": "練習問題",
-                "rationale": "為什麼這個問題對揭示誤解有效",
-                "expectedMisconceptions": ["常見誤解1", "常見誤解2", "常見誤解3"]
-            }}
-            
-            僅回覆有效的JSON，不要其他文字或markdown格式。
-            """
-        else:
-            question_template = """
-            Generate a high-quality practice question for a {grade_level} {subject} class.
-            
-            Learning Outcomes: {learning_outcomes}
-            Key Concepts: {concepts}
-            
+
+def _sections(*sections: str) -> str:
+    """Join prompt paragraphs with blank lines, laid out like the other prompt strings"""
+    return "\n            ".join(sections) + "\n            "
+
+def _json_format(header: str, *field_groups: str) -> str:
+    """Paragraph asking for one JSON object made of the given field groups"""
+    return f"\n            {header}\n            {{" + ",".join(field_groups) + "\n            }"
+
+# Paragraphs shared by the question, scenario and one-call session instructions, so the
+# three prompts can't drift apart when one of them is edited
+QUESTION_CRITERIA = {
+    "english": """
             Create a question that:
             1. Is open-ended and encourages student thinking
             2. Allows for multiple approaches or explanations
             3. Can reveal common misconceptions about the concepts
-            4. Is age-appropriate for {grade_level} level
-            5. Connects to the specified learning outcomes
-            
-            The question should be designed to help teachers diagnose student understanding and identify misconceptions.
-            
-            Return response in this JSON format:
-            {{
-                "question": "the practice question",
-                "rationale": "why this question is effective for revealing misconceptions",
-                "expectedMisconceptions": ["common misconception 1", "common misconception 2", "common misconception 3"]
-            }}
-            
-            Return ONLY valid JSON, no other text or markdown formatting.
-            """
-        
-        prompt = language_prefix + question_template.format(
-            grade_level=grade_level,
-            subject=subject,
-            learning_outcomes=learning_outcomes,
-            concepts=concepts
-        )
-        
-        print(f"🔄 Calling Gemini API for question generation...")
-        if self.model is None:
-            raise HTTPException(status_code=503, detail="AI service unavailable")
-        response = self.model.generate_content(prompt)
-        print(f"✅ Gemini API response received")
-        
-        # Clean and parse the JSON response
-        clean_text = self._clean_json_response(response.text)
-        question_data = json.loads(clean_text)
-        return question_data
-    
-    def generate_scenario(self, grade_level: str, subject: str, learning_outcomes: str, concepts: str, question: Optional[str], persona: StudentPersona, language: str = "english") -> Dict[str, Any]:
-        """Generate a complete teaching scenario with student profile and misconceptions"""
-        
-        self._check_api_available()
-        
-        if not question:
-            raise ValueError("Question is required for scenario generation")
-        
-        language_prefix = self._get_language_prefix(language)
-        
-        # Build persona description for AI
-        if language == "traditional_chinese":
-            persona_description = f"""
-            學生特徵：
-            - 概念準備度：{persona.conceptual_readiness}/10 (先前知識強度)
-            - 後設認知意識：{persona.metacognitive_awareness}/10 (識別自己理解/困惑的能力)
-            - 堅持度：{persona.persistence}/10 (克服困難的意願)
-            - 溝通風格：{persona.communication_style} (偏好{persona.communication_style}解釋)
-            - 信心水平：{persona.confidence_level}/10 (分享思考和提問的意願)
-            
+            4. Is age-appropriate for the class's grade level
+            5. Connects to the specified learning outcomes""",
+    "traditional_chinese": """
+            創建一個問題，要求：
+            1. 是開放式的，鼓勵學生思考
+            2. 允許多種方法或解釋
+            3. 可以揭示關於概念的常見誤解
+            4. 適合該課程的年級水平
+            5. 與指定的學習成果相關""",
+}
+
+STUDENT_REASONING = {
+    "english": """
+            The student should have a clear, logical (but incorrect) understanding that leads to their wrong answer.""",
+    "traditional_chinese": """
+            學生應該有清晰、邏輯性（但不正確）的理解，導致錯誤答案。""",
+}
+
+BEHAVIOR_GUIDELINES = {
+    "english": """
+            Behavioral Guidelines:
+            - If confidence is low (1-3): Student is hesitant, asks for validation, says "I think maybe..."
+            - If confidence is high (8-10): Student is assertive, states opinions confidently
+            - If persistence is low (1-3): Student gives up quickly, says "I don't know" often
+            - If persistence is high (8-10): Student keeps trying, asks follow-up questions
+            - If metacognitive awareness is low (1-3): Student doesn't recognize their mistakes or confusion
+            - If metacognitive awareness is high (8-10): Student says things like "I'm confused about..." or "I think I understand but..."
+            - If communication style is "visual": Student asks for pictures/diagrams, describes spatial relationships
+            - If communication style is "hands_on": Student wants to try things, mentions physical examples
+            - If communication style is "verbal": Student prefers explanations, asks for definitions""",
+    "traditional_chinese": """
             行為指導：
             - 如果信心低 (1-3)：學生猶豫不決，尋求確認，說「我想可能...」
             - 如果信心高 (8-10)：學生自信，明確表達意見
@@ -270,30 +462,47 @@ class GeminiService:
             - 如果後設認知意識高 (8-10)：學生會說「我對...感到困惑」或「我想我明白但是...」
             - 如果溝通風格是「視覺」：學生要求圖片/圖表，描述空間關係
             - 如果溝通風格是「動手」：學生想要嘗試事物，提及實際例子
-            - 如果溝通風格是「口語」：學生偏好解釋，詢問定義
-            """
-            
-            scenario_template = """
-            為 {grade_level} {subject} 課程創建一個現實的教學情境。
-            
-            學習成果：{learning_outcomes}
-            關鍵概念：{concepts}
-            練習問題：{question}
-            
-            {persona_description}
-            
-            生成一個會對這個具體問題回應現實誤解的學生。
-            學生應該有清晰、邏輯性（但不正確）的理解，導致錯誤答案。
-            
-            以這個JSON格式生成回應：
-            {{
-                "student": {{
+            - 如果溝通風格是「口語」：學生偏好解釋，詢問定義""",
+}
+
+# Field groups of the JSON formats, joined into one object by _json_format
+QUESTION_FIELDS = {
+    "english": """
+                "question": "the practice question",
+                "rationale": "why this question is effective for revealing misconceptions",
+                "expectedMisconceptions": ["common misconception 1", "common misconception 2", "common misconception 3"]""",
+    "traditional_chinese": """
+                "question": "練習問題",
+                "rationale": "為什麼這個問題對揭示誤解有效",
+                "expectedMisconceptions": ["常見誤解1", "常見誤解2", "常見誤解3"]""",
+}
+
+SCENARIO_FIELDS = {
+    "english": """
+                "student": {
+                    "name": "realistic first name",
+                    "background": "brief background that reflects the student's persona characteristics",
+                    "performanceLevel": "struggling/average/advanced",
+                    "actualMisconception": "the specific misconception this student has about the concepts",
+                    "initialResponse": "how the student responds to the practice question - should show their misconception and persona traits"
+                },
+                "misconceptionOptions": [
+                    "The correct misconception (this student's actual issue)",
+                    "Plausible but incorrect misconception 1",
+                    "Plausible but incorrect misconception 2",
+                    "Plausible but incorrect misconception 3"
+                ],
+                "correctMisconceptionIndex": 0,
+                "topic": "specific topic being discussed",
+                "difficulty": "beginner/intermediate/advanced\"""",
+    "traditional_chinese": """
+                "student": {
                     "name": "現實的名字",
                     "background": "反映學生人格特徵的簡短背景",
                     "performanceLevel": "掙扎/平均/優秀",
                     "actualMisconception": "這個學生對概念的具體誤解",
                     "initialResponse": "學生如何回應練習問題 - 應顯示他們的誤解和人格特徵"
-                }},
+                },
                 "misconceptionOptions": [
                     "正確的誤解（這個學生的實際問題）",
                     "似是而非但不正確的誤解1",
@@ -302,158 +511,187 @@ class GeminiService:
                 ],
                 "correctMisconceptionIndex": 0,
                 "topic": "討論的具體主題",
-                "difficulty": "初級/中級/進階",
-                "persona": {{
-                    "conceptual_readiness": {persona.conceptual_readiness},
-                    "metacognitive_awareness": {persona.metacognitive_awareness},
-                    "persistence": {persona.persistence},
-                    "communication_style": "{persona.communication_style}",
-                    "confidence_level": {persona.confidence_level}
-                }},
-                "practiceQuestion": "{question}"
-            }}
-            
+                "difficulty": "初級/中級/進階\"""",
+}
+
+SCENARIO_CHECKS = {
+    "english": """
+            Make sure the student's initial response directly addresses the practice question and reveals their misconception.
+            The response should also clearly reflect their persona characteristics.""",
+    "traditional_chinese": """
             確保學生的初始回應直接回答練習問題並揭示他們的誤解。
-            回應也應該清楚地反映他們的人格特徵。
-            
-            僅回覆有效的JSON，不要其他文字或markdown格式。
-            """
-        else:
-            persona_description = f"""
+            回應也應該清楚地反映他們的人格特徵。""",
+}
+
+JSON_ONLY = {
+    "english": """
+            Return ONLY valid JSON, no other text or markdown formatting.""",
+    "traditional_chinese": """
+            僅回覆有效的JSON，不要其他文字或markdown格式。""",
+}
+
+# The student's traits as sent with each scenario/session request (formatted with persona=)
+PERSONA_CHARACTERISTICS = {
+    "english": """
             Student Characteristics:
             - Conceptual Readiness: {persona.conceptual_readiness}/10 (prior knowledge strength)
             - Metacognitive Awareness: {persona.metacognitive_awareness}/10 (ability to recognize own understanding/confusion)
             - Persistence: {persona.persistence}/10 (willingness to work through difficulty)
             - Communication Style: {persona.communication_style} (prefers {persona.communication_style} explanations)
-            - Confidence Level: {persona.confidence_level}/10 (willingness to share thinking and ask questions)
-            
-            Behavioral Guidelines:
-            - If confidence is low (1-3): Student is hesitant, asks for validation, says "I think maybe..." 
-            - If confidence is high (8-10): Student is assertive, states opinions confidently
-            - If persistence is low (1-3): Student gives up quickly, says "I don't know" often
-            - If persistence is high (8-10): Student keeps trying, asks follow-up questions
-            - If metacognitive awareness is low (1-3): Student doesn't recognize their mistakes or confusion
-            - If metacognitive awareness is high (8-10): Student says things like "I'm confused about..." or "I think I understand but..."
-            - If communication style is "visual": Student asks for pictures/diagrams, describes spatial relationships
-            - If communication style is "hands_on": Student wants to try things, mentions physical examples
-            - If communication style is "verbal": Student prefers explanations, asks for definitions
-            """
-            
-            scenario_template = """
-            Create a realistic teaching scenario for a {grade_level} {subject} class.
+            - Confidence Level: {persona.confidence_level}/10 (willingness to share thinking and ask questions)""",
+    "traditional_chinese": """
+            學生特徵：
+            - 概念準備度：{persona.conceptual_readiness}/10 (先前知識強度)
+            - 後設認知意識：{persona.metacognitive_awareness}/10 (識別自己理解/困惑的能力)
+            - 堅持度：{persona.persistence}/10 (克服困難的意願)
+            - 溝通風格：{persona.communication_style} (偏好{persona.communication_style}解釋)
+            - 信心水平：{persona.confidence_level}/10 (分享思考和提問的意願)""",
+}
+
+QUESTION_INSTRUCTIONS = {
+    "english": _sections(
+        """
+            Generate a high-quality practice question for the class described by the user.""",
+        QUESTION_CRITERIA["english"],
+        """
+            The question should be designed to help teachers diagnose student understanding and identify misconceptions.""",
+        _json_format("Return response in this JSON format:", QUESTION_FIELDS["english"]),
+        JSON_ONLY["english"],
+    ),
+    "traditional_chinese": LANGUAGE_PREFIX_ZH + _sections(
+        """
+            為使用者描述的課程生成一個高質量的練習問題。""",
+        QUESTION_CRITERIA["traditional_chinese"],
+        """
+            問題應該設計來幫助教師診斷學生理解並識別誤解。""",
+        _json_format("以這個JSON格式回覆：", QUESTION_FIELDS["traditional_chinese"]),
+        JSON_ONLY["traditional_chinese"],
+    ),
+}
+
+QUESTION_PROMPTS = {
+    "english": """
+            Generate a high-quality practice question for a {grade_level} {subject} class.
             
             Learning Outcomes: {learning_outcomes}
             Key Concepts: {concepts}
-            Practice Question: {question}
-            
-            {persona_description}
-            
-            Generate a student who will respond to this specific question with a realistic misconception.
-            The student should have a clear, logical (but incorrect) understanding that leads to their wrong answer.
-            
-            Generate a response in this JSON format:
-            {{
-                "student": {{
-                    "name": "realistic first name",
-                    "background": "brief background that reflects the student's persona characteristics",
-                    "performanceLevel": "struggling/average/advanced",
-                    "actualMisconception": "the specific misconception this student has about the concepts",
-                    "initialResponse": "how the student responds to the practice question - should show their misconception and persona traits"
-                }},
-                "misconceptionOptions": [
-                    "The correct misconception (this student's actual issue)",
-                    "Plausible but incorrect misconception 1",
-                    "Plausible but incorrect misconception 2", 
-                    "Plausible but incorrect misconception 3"
-                ],
-                "correctMisconceptionIndex": 0,
-                "topic": "specific topic being discussed",
-                "difficulty": "beginner/intermediate/advanced",
-                "persona": {{
-                    "conceptual_readiness": {persona.conceptual_readiness},
-                    "metacognitive_awareness": {persona.metacognitive_awareness},
-                    "persistence": {persona.persistence},
-                    "communication_style": "{persona.communication_style}",
-                    "confidence_level": {persona.confidence_level}
-                }},
-                "practiceQuestion": "{question}"
-            }}
-            
-            Make sure the student's initial response directly addresses the practice question and reveals their misconception.
-            The response should also clearly reflect their persona characteristics.
-            
-            Return ONLY valid JSON, no other text or markdown formatting.
-            """
-        
-        prompt = language_prefix + scenario_template.format(
-            grade_level=grade_level,
-            subject=subject,
-            learning_outcomes=learning_outcomes,
-            concepts=concepts,
-            question=question,
-            persona_description=persona_description,
-            persona=persona
-        )
-        
-        print(f"🔄 Calling Gemini API for scenario generation with question...")
-        if self.model is None:
-            raise HTTPException(status_code=503, detail="AI service unavailable")
-        response = self.model.generate_content(prompt)
-        print(f"✅ Gemini API response received")
-        
-        # Clean and parse the JSON response
-        clean_text = self._clean_json_response(response.text)
-        scenario_data = json.loads(clean_text)
-        return scenario_data
-    
-    def generate_student_response(self, scenario: Dict[str, Any], teacher_message: str, chat_history: List[Dict[str, str]], language: str = "english") -> str:
-        """Generate student response based on their misconception and persona"""
-        
-        self._check_api_available()
-        
-        student = scenario.get('student', {})
-        misconception = student.get('actualMisconception', '')
-        persona = scenario.get('persona', {})
-        practice_question = scenario.get('practiceQuestion', '')
-        
-        language_prefix = self._get_language_prefix(language)
-        
-        # Build context from chat history
-        context = ""
-        for msg in chat_history[-6:]:  # Last 6 messages for context
-            context += f"{msg['sender'].title()}: {msg['message']}\n"
-        
-        # Build persona behavior guidance
-        if language == "traditional_chinese":
-            persona_guidance = f"""
-            要維持的人格特徵：
-            - 概念準備度：{persona.get('conceptual_readiness', 5)}/10
-            - 後設認知意識：{persona.get('metacognitive_awareness', 5)}/10  
-            - 堅持度：{persona.get('persistence', 5)}/10
-            - 溝通風格：{persona.get('communication_style', 'verbal')}
-            - 信心水平：{persona.get('confidence_level', 5)}/10
-            
-            行為一致性：
-            - 信心 {persona.get('confidence_level', 5)}/10：{"猶豫不決，使用「可能」、「我想」，尋求確認" if persona.get('confidence_level', 5) <= 3 else "自信並清楚表達意見" if persona.get('confidence_level', 5) >= 8 else "表現中等信心"}
-            - 堅持度 {persona.get('persistence', 5)}/10：{"容易放棄，經常說「我不知道」" if persona.get('persistence', 5) <= 3 else "持續嘗試，提出後續問題" if persona.get('persistence', 5) >= 8 else "表現平均堅持度"}
-            - 後設認知 {persona.get('metacognitive_awareness', 5)}/10：{"不認識自己的錯誤或困惑" if persona.get('metacognitive_awareness', 5) <= 3 else "會說「我對...感到困惑」或「我想我明白但是...」" if persona.get('metacognitive_awareness', 5) >= 8 else "表現中等後設認知意識"}
-            - 溝通：{f"要求圖表/圖片，描述空間關係" if persona.get('communication_style') == 'visual' else f"想要嘗試事物，提及實際例子" if persona.get('communication_style') == 'hands_on' else "偏好口語解釋，詢問定義"}
-            """
+            """,
+    "traditional_chinese": """
+            為 {grade_level} {subject} 課程生成一個高質量的練習問題。
             
-            response_template = """
-            你正在扮演 {student_name}，他是一個在 {topic} 方面表現{performance_level}的學生。
+            學習成果：{learning_outcomes}
+            關鍵概念：{concepts}
+            """,
+}
 
-            你的背景：{background}
-            你的具體誤解：{misconception}
-            原始練習問題：{practice_question}
-            
-            {persona_guidance}
+SCENARIO_INSTRUCTIONS = {
+    "english": _sections(
+        """
+            Create a realistic teaching scenario for the class described by the user.""",
+        """
+            Generate a student who will respond to the practice question with a realistic misconception.""" + STUDENT_REASONING["english"],
+        BEHAVIOR_GUIDELINES["english"],
+        _json_format("Generate a response in this JSON format:", SCENARIO_FIELDS["english"]),
+        SCENARIO_CHECKS["english"],
+        JSON_ONLY["english"],
+    ),
+    "traditional_chinese": LANGUAGE_PREFIX_ZH + _sections(
+        """
+            為使用者描述的課程創建一個現實的教學情境。""",
+        """
+            生成一個會對練習問題回應現實誤解的學生。""" + STUDENT_REASONING["traditional_chinese"],
+        BEHAVIOR_GUIDELINES["traditional_chinese"],
+        _json_format("以這個JSON格式生成回應：", SCENARIO_FIELDS["traditional_chinese"]),
+        SCENARIO_CHECKS["traditional_chinese"],
+        JSON_ONLY["traditional_chinese"],
+    ),
+}
 
-            最近的對話：
-            {context}
+SCENARIO_PROMPTS = {
+    "english": _sections(
+        """
+            Create a realistic teaching scenario for a {grade_level} {subject} class.""",
+        """
+            Learning Outcomes: {learning_outcomes}
+            Key Concepts: {concepts}
+            Practice Question: {question}""",
+        PERSONA_CHARACTERISTICS["english"],
+    ),
+    "traditional_chinese": _sections(
+        """
+            為 {grade_level} {subject} 課程創建一個現實的教學情境。""",
+        """
+            學習成果：{learning_outcomes}
+            關鍵概念：{concepts}
+            練習問題：{question}""",
+        PERSONA_CHARACTERISTICS["traditional_chinese"],
+    ),
+}
 
-            老師剛剛問：「{teacher_message}」
+# One call producing the question and the student together, for /api/start-session
+SESSION_INSTRUCTIONS = {
+    "english": _sections(
+        """
+            Create a complete teaching session for the class described by the user: a practice question, and a student who answers it with a realistic misconception.""",
+        QUESTION_CRITERIA["english"],
+        STUDENT_REASONING["english"],
+        BEHAVIOR_GUIDELINES["english"],
+        _json_format("Generate a response in this JSON format:", QUESTION_FIELDS["english"], SCENARIO_FIELDS["english"]),
+        SCENARIO_CHECKS["english"],
+        JSON_ONLY["english"],
+    ),
+    "traditional_chinese": LANGUAGE_PREFIX_ZH + _sections(
+        """
+            為使用者描述的課程創建一個完整的教學會話：一個練習問題，以及一個會以現實誤解回答該問題的學生。""",
+        QUESTION_CRITERIA["traditional_chinese"],
+        STUDENT_REASONING["traditional_chinese"],
+        BEHAVIOR_GUIDELINES["traditional_chinese"],
+        _json_format("以這個JSON格式生成回應：", QUESTION_FIELDS["traditional_chinese"], SCENARIO_FIELDS["traditional_chinese"]),
+        SCENARIO_CHECKS["traditional_chinese"],
+        JSON_ONLY["traditional_chinese"],
+    ),
+}
+
+SESSION_PROMPTS = {
+    "english": _sections(
+        """
+            Create a complete teaching session for a {grade_level} {subject} class.""",
+        """
+            Learning Outcomes: {learning_outcomes}
+            Key Concepts: {concepts}""",
+        PERSONA_CHARACTERISTICS["english"],
+    ),
+    "traditional_chinese": _sections(
+        """
+            為 {grade_level} {subject} 課程創建一個完整的教學會話。""",
+        """
+            學習成果：{learning_outcomes}
+            關鍵概念：{concepts}""",
+        PERSONA_CHARACTERISTICS["traditional_chinese"],
+    ),
+}
 
+STUDENT_INSTRUCTIONS = {
+    "english": """
+            You will roleplay as the student described by the user, replying to the teacher's latest message.
+            
+            IMPORTANT RESPONSE GUIDELINES:
+            1. Your responses should be REASONED and logical from your perspective
+            2. Show your thinking process - explain WHY you think something is correct
+            3. Your misconception should lead to consistent, logical (but wrong) reasoning
+            4. Don't just give random wrong answers - give answers that make sense given your misconception
+            5. Stay true to your persona characteristics throughout
+            6. If the teacher asks you to explain, show your reasoning step by step
+            7. If asked about the original question, refer back to your misconception-based understanding
+            
+            Respond as this student would, showing both your misconception-based reasoning AND your persona traits.
+            Keep responses conversational and age-appropriate for the scenario's difficulty level.
+            
+            Return ONLY the student's response, no other text or formatting.
+            """,
+    "traditional_chinese": LANGUAGE_PREFIX_ZH + """
+            你將扮演使用者描述的學生，回應老師的最新提問。
+            
             重要回應指導：
             1. 你的回應應該是有推理的，從你的角度來說是邏輯性的
             2. 展示你的思考過程 - 解釋為什麼你認為某事是正確的
@@ -464,28 +702,16 @@ class GeminiService:
             7. 如果問及原始問題，請參考你基於誤解的理解
             
             像這個學生一樣回應，展示你基於誤解的推理和人格特徵。
-            保持對話性和適合{difficulty}難度的年齡。
+            保持對話性和適合情境難度的年齡。
             
             僅回覆學生的回應，不要其他文字或格式。
-            """
-        else:
-            persona_guidance = f"""
-            PERSONA CHARACTERISTICS TO MAINTAIN:
-            - Conceptual Readiness: {persona.get('conceptual_readiness', 5)}/10
-            - Metacognitive Awareness: {persona.get('metacognitive_awareness', 5)}/10  
-            - Persistence: {persona.get('persistence', 5)}/10
-            - Communication Style: {persona.get('communication_style', 'verbal')}
-            - Confidence Level: {persona.get('confidence_level', 5)}/10
-            
-            BEHAVIORAL CONSISTENCY:
-            - Confidence {persona.get('confidence_level', 5)}/10: {"Be hesitant, use 'maybe', 'I think', ask for validation" if persona.get('confidence_level', 5) <= 3 else "Be assertive and state opinions clearly" if persona.get('confidence_level', 5) >= 8 else "Show moderate confidence"}
-            - Persistence {persona.get('persistence', 5)}/10: {"Give up quickly, say 'I don't know' often" if persona.get('persistence', 5) <= 3 else "Keep trying, ask follow-up questions" if persona.get('persistence', 5) >= 8 else "Show average persistence"}
-            - Metacognitive {persona.get('metacognitive_awareness', 5)}/10: {"Don't recognize own mistakes or confusion" if persona.get('metacognitive_awareness', 5) <= 3 else "Say things like 'I'm confused about...' or 'I think I understand but...'" if persona.get('metacognitive_awareness', 5) >= 8 else "Show moderate metacognitive awareness"}
-            - Communication: {f"Ask for diagrams/pictures, describe spatial relationships" if persona.get('communication_style') == 'visual' else f"Want to try things, mention physical examples" if persona.get('communication_style') == 'hands_on' else "Prefer verbal explanations, ask for definitions"}
-            """
-            
-            response_template = """
+            """,
+}
+
+STUDENT_PROMPTS = {
+    "english": """
             You are roleplaying as {student_name} who is {performance_level} in {topic}.
+            Difficulty level: {difficulty}
 
             Your Background: {background}
             Your Specific Misconception: {misconception}
@@ -497,88 +723,130 @@ class GeminiService:
             {context}
 
             The teacher just asked: "{teacher_message}"
+            """,
+    "traditional_chinese": """
+            你正在扮演 {student_name}，他是一個在 {topic} 方面表現{performance_level}的學生。
+            情境難度：{difficulty}
 
-            IMPORTANT RESPONSE GUIDELINES:
-            1. Your responses should be REASONED and logical from your perspective
-            2. Show your thinking process - explain WHY you think something is correct
-            3. Your misconception should lead to consistent, logical (but wrong) reasoning
-            4. Don't just give random wrong answers - give answers that make sense given your misconception
-            5. Stay true to your persona characteristics throughout
-            6. If the teacher asks you to explain, show your reasoning step by step
-            7. If asked about the original question, refer back to your misconception-based understanding
+            你的背景：{background}
+            你的具體誤解：{misconception}
+            原始練習問題：{practice_question}
+            
+            {persona_guidance}
+
+            最近的對話：
+            {context}
+
+            老師剛剛問：「{teacher_message}」
+            """,
+}
+
+PERSONA_GUIDANCE = {
+    "english": """
+            PERSONA CHARACTERISTICS TO MAINTAIN:
+            - Conceptual Readiness: {readiness}/10
+            - Metacognitive Awareness: {metacog}/10  
+            - Persistence: {persistence}/10
+            - Communication Style: {style}
+            - Confidence Level: {confidence}/10
+            
+            BEHAVIORAL CONSISTENCY:
+            - Confidence {confidence}/10: {confidence_guide}
+            - Persistence {persistence}/10: {persistence_guide}
+            - Metacognitive {metacog}/10: {metacog_guide}
+            - Communication: {comm_guide}
+            """,
+    "traditional_chinese": """
+            要維持的人格特徵：
+            - 概念準備度：{readiness}/10
+            - 後設認知意識：{metacog}/10  
+            - 堅持度：{persistence}/10
+            - 溝通風格：{style}
+            - 信心水平：{confidence}/10
+            
+            行為一致性：
+            - 信心 {confidence}/10：{confidence_guide}
+            - 堅持度 {persistence}/10：{persistence_guide}
+            - 後設認知 {metacog}/10：{metacog_guide}
+            - 溝通：{comm_guide}
+            """,
+}
+
+PERSONA_GUIDES = {
+    "english": (CONFIDENCE_GUIDE, PERSISTENCE_GUIDE, METACOG_GUIDE, COMM_GUIDANCE),
+    "traditional_chinese": (CONFIDENCE_GUIDE_ZH, PERSISTENCE_GUIDE_ZH, METACOG_GUIDE_ZH, COMM_GUIDANCE_ZH),
+}
+
+# The student only sees a short window of the chat, each message clipped, so the prompt
+# stays roughly constant in size however long the session runs (the teacher's new
+# message is always sent in full)
+CONTEXT_MESSAGES = 6
+CONTEXT_MESSAGE_CHARS = 600
+
+def _clip(text: str, limit: int = CONTEXT_MESSAGE_CHARS) -> str:
+    """Shorten text to about limit characters, keeping its start and end"""
+    if len(text) <= limit:
+        return text
+    half = limit // 2
+    return f"{text[:half]} … {text[-half:]}"
+
+# 10^4 trait combinations x 3 styles x 2 languages at most, and a chat reuses one persona every turn
+@functools.lru_cache(maxsize=4096)
+def _persona_guidance(persona: "StudentPersona", language: str) -> str:
+    """Persona behavior block for the student prompt"""
+    confidence_guides, persistence_guides, metacog_guides, comm_guides = _localized(PERSONA_GUIDES, language)
+    return _localized(PERSONA_GUIDANCE, language).format(
+        readiness=persona.conceptual_readiness,
+        metacog=persona.metacognitive_awareness,
+        persistence=persona.persistence,
+        style=persona.communication_style,
+        confidence=persona.confidence_level,
+        confidence_guide=confidence_guides[persona.confidence_level],
+        persistence_guide=persistence_guides[persona.persistence],
+        metacog_guide=metacog_guides[persona.metacognitive_awareness],
+        comm_guide=comm_guides[persona.communication_style]
+    )
+
+EVALUATION_INSTRUCTIONS = {
+    "english": """
+            Evaluate the teaching session provided by the user.
             
-            Respond as this student would, showing both your misconception-based reasoning AND your persona traits.
-            Keep responses conversational and age-appropriate for {difficulty} level.
+            Provide evaluation in this JSON format:
+            {
+                "score": 85,
+                "questioningScore": 8,
+                "correctMisconception": "the student's actual misconception",
+                "feedback": "detailed feedback on the teacher's performance, including question quality, diagnostic accuracy, and intervention effectiveness",
+                "improvements": ["specific suggestion 1", "specific suggestion 2", "specific suggestion 3"]
+            }
             
-            Return ONLY the student's response, no other text or formatting.
-            """
-        
-        prompt = language_prefix + response_template.format(
-            student_name=student.get('name', 'a student'),
-            performance_level=student.get('performanceLevel', 'average'),
-            topic=scenario.get('topic', 'this subject'),
-            background=student.get('background', ''),
-            misconception=misconception,
-            practice_question=practice_question,
-            persona_guidance=persona_guidance,
-            context=context,
-            teacher_message=teacher_message,
-            difficulty=scenario.get('difficulty', 'intermediate')
-        )
-        
-        print(f"🔄 Calling Gemini API for reasoned student response...")
-        if self.model is None:
-            raise HTTPException(status_code=503, detail="AI service unavailable")
-        response = self.model.generate_content(prompt)
-        print(f"✅ Gemini API response received")
-        
-        return response.text.strip()
-    
-    def evaluate_session(self, scenario: Dict[str, Any], selected_misconception: int, intervention: str, chat_history: List[Dict[str, str]], selected_strategy: Optional[str] = None, language: str = "english") -> Dict[str, Any]:
-        """Evaluate the teacher's diagnosis and intervention"""
-        
-        self._check_api_available()
-        
-        correct_index = scenario.get('correctMisconceptionIndex', 0)
-        correct_diagnosis = selected_misconception == correct_index
-        
-        # Count teacher questions
-        teacher_questions = len([msg for msg in chat_history if msg['sender'] == 'teacher'])
-        
-        language_prefix = self._get_language_prefix(language)
-        
-        # Build evaluation prompt
-        chat_text = ""
-        for msg in chat_history:
-            chat_text += f"{msg['sender'].title()}: {msg['message']}\n"
-        
-        strategy_context = f"Selected Teaching Strategy: {selected_strategy}" if selected_strategy else "No specific strategy selected"
-        
-        if language == "traditional_chinese":
-            # Handle conditional text outside the template
-            correct_diagnosis_text = "是" if correct_diagnosis else "否"
-            evaluation_template = """
-            評估這次教學會話：
+            Score the session 0-100 based on:
+            - Diagnostic accuracy (35 points)
+            - Quality of questioning (30 points) 
+            - Intervention effectiveness (25 points)
+            - Use of teaching strategies (10 points)
             
-            學生的實際誤解：{actual_misconception}
-            教師的診斷：{teacher_diagnosis}
-            正確診斷：{correct_diagnosis_text}
+            Questioning score (1-10) based on:
+            - Probing questions that reveal student thinking
+            - Progression from general to specific
+            - Avoiding leading questions
+            - Encouraging student reasoning
             
-            教師的介入：{intervention}
-            {strategy_context}
+            Consider the teaching strategy used (if any) in your evaluation.
             
-            聊天記錄：
-            {chat_text}
+            Return ONLY valid JSON, no other text or markdown formatting.
+            """,
+    "traditional_chinese": LANGUAGE_PREFIX_ZH + """
+            評估使用者提供的教學會話。
             
             以這個JSON格式提供評估：
-            {{
-                "correctDiagnosis": {correct_diagnosis_json},
+            {
                 "score": 85,
                 "questioningScore": 8,
                 "correctMisconception": "學生的實際誤解",
                 "feedback": "對教師表現的詳細反饋，包括問題質量、診斷準確性和介入有效性",
                 "improvements": ["具體建議1", "具體建議2", "具體建議3"]
-            }}
+            }
             
             根據以下標準評分0-100分：
             - 診斷準確性（35分）
@@ -595,10 +863,11 @@ class GeminiService:
             在評估中考慮所使用的教學策略（如有）。
             
             僅回覆有效的JSON，不要其他文字或markdown格式。
-            """
-        else:
-            correct_diagnosis_text = "YES" if correct_diagnosis else "NO"
-            evaluation_template = """
+            """,
+}
+
+EVALUATION_PROMPTS = {
+    "english": """
             Evaluate this teaching session:
             
             Student's Actual Misconception: {actual_misconception}
@@ -610,118 +879,788 @@ class GeminiService:
             
             Chat History:
             {chat_text}
+            """,
+    "traditional_chinese": """
+            評估這次教學會話：
             
-            Provide evaluation in this JSON format:
-            {{
-                "correctDiagnosis": {correct_diagnosis_json},
-                "score": 85,
-                "questioningScore": 8,
-                "correctMisconception": "the student's actual misconception",
-                "feedback": "detailed feedback on the teacher's performance, including question quality, diagnostic accuracy, and intervention effectiveness",
-                "improvements": ["specific suggestion 1", "specific suggestion 2", "specific suggestion 3"]
-            }}
+            學生的實際誤解：{actual_misconception}
+            教師的診斷：{teacher_diagnosis}
+            正確診斷：{correct_diagnosis_text}
             
-            Score the session 0-100 based on:
-            - Diagnostic accuracy (35 points)
-            - Quality of questioning (30 points) 
-            - Intervention effectiveness (25 points)
-            - Use of teaching strategies (10 points)
+            教師的介入：{intervention}
+            {strategy_context}
             
-            Questioning score (1-10) based on:
-            - Probing questions that reveal student thinking
-            - Progression from general to specific
-            - Avoiding leading questions
-            - Encouraging student reasoning
+            聊天記錄：
+            {chat_text}
+            """,
+}
+
+# Indexed by whether the diagnosis was correct
+DIAGNOSIS_LABELS = {
+    "english": ("NO", "YES"),
+    "traditional_chinese": ("否", "是"),
+}
+
+def _scenario_is_usable(data: Dict[str, Any]) -> bool:
+    """Cheap structural check on a generated scenario before it reaches the teacher"""
+    student = data.get("student") or {}
+    options = data.get("misconceptionOptions") or []
+    index = data.get("correctMisconceptionIndex")
+    return (
+        len(options) == 4
+        and all(isinstance(option, str) and option.strip() for option in options)
+        and isinstance(index, int) and 0 <= index < len(options)
+        and all(str(student.get(field) or "").strip() for field in ("name", "actualMisconception", "initialResponse"))
+    )
+
+# Gemini AI service
+class GeminiService:
+    def __init__(self):
+        self.model = None
+        self.chat_model = None
+        self.eval_model = None
+        self.fallback_model = None
+        self._api_key = None
+        self._client = None
+        self._http = None
+        self._prompt_caches: Dict[tuple, Any] = {}
+        self._background_tasks = set()
+        self._semantic_cache = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD)
+        # Chat turns get their own cache so a busy classroom can't evict question/scenario entries
+        self._reply_cache = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD)
+        self._request_limiter = TokenBucket(GEMINI_RPM) if GEMINI_RPM > 0 else None
+        self._token_limiter = TokenBucket(GEMINI_TPM) if GEMINI_TPM > 0 else None
+        self._breaker = CircuitBreaker("Gemini API", BREAKER_FAIL_MAX, BREAKER_RESET_TIMEOUT)
+        self._initialize_model()
+        # The key can't change at runtime, so availability is decided once here
+        self.available = self.model is not None
+    
+    def _initialize_model(self):
+        """Initialize the Gemini model only when needed"""
+        try:
+            api_key = API_KEY
+            logger.debug("🔍 Checking API key - present: %s, length: %d", bool(api_key), len(api_key) if api_key else 0)
             
-            Consider the teaching strategy used (if any) in your evaluation.
+            if api_key:
+                self._api_key = api_key
+                # Use gemini-2.5-flash as the primary model; the client itself is created on first use
+                self.model = DEFAULT_MODEL
+                self.chat_model = CHAT_MODEL
+                self.eval_model = EVAL_MODEL
+                self.fallback_model = FALLBACK_MODEL if FALLBACK_MODEL != DEFAULT_MODEL else None
+                print(f"🚀 Gemini API model initialized successfully with {self.model} (chat: {self.chat_model}, evaluation: {self.eval_model})")
+            else:
+                print("⚠️  Gemini API not initialized - no API key found")
+                logger.debug("🔍 GOOGLE_API_KEY set: %s, GEMINI_API_KEY set: %s", "GOOGLE_API_KEY" in os.environ, "GEMINI_API_KEY" in os.environ)
+        except Exception as e:
+            # Formatting the stack is costly, so only attach it when DEBUG is set
+            logger.error("❌ Error initializing Gemini API: %s", e, exc_info=DEBUG)
+            self.model = None
+    
+    def _get_client(self) -> genai.Client:
+        """Return the shared Gemini client, creating it (and its connection pool) on first use"""
+        if self._client is None:
+            # One keep-alive pool per process: warm invocations skip the TCP + TLS handshake,
+            # and with HTTP/2 concurrent calls share a single connection
+            self._http = httpx.AsyncClient(
+                http2=HTTP2_ENABLED,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=100, keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY)
+            )
+            self._client = genai.Client(
+                api_key=self._api_key,
+                http_options=types.HttpOptions(
+                    httpx_async_client=self._http,
+                    timeout=int(GEMINI_TIMEOUT * 1000),  # milliseconds, per attempt
+                    retry_options=GEMINI_RETRY
+                )
+            )
+        return self._client
+    
+    async def warmup(self):
+        """Fetch the model's metadata to open a pooled connection without spending tokens"""
+        try:
+            await self._get_client().aio.models.get(model=self.model)
+            logger.info("🔥 Gemini connection warmed up")
+        except Exception as e:
+            # Not fatal: the first real request just opens the connection itself
+            logger.warning("⚠️ Gemini warmup failed: %s", e)
+    
+    async def aclose(self):
+        """Close the pooled HTTP connections on shutdown"""
+        if self._http is not None:
+            await self._http.aclose()
+        self._client = None
+        self._http = None
+        self._prompt_caches.clear()
+    
+    def _instruction_config(self, key: tuple, model: str, system_instruction: str, response_schema: Optional[type] = None) -> types.GenerateContentConfig:
+        """Config carrying the static instructions, by cache reference when one exists"""
+        max_tokens, temperature = GENERATION_SETTINGS[key[0]]
+        output = {
+            "max_output_tokens": max_tokens + THINKING_BUDGET,
+            "temperature": temperature,
+            "thinking_config": types.ThinkingConfig(thinking_budget=THINKING_BUDGET),
+        }
+        if response_schema:
+            # With a schema Gemini returns bare JSON (no markdown fences) that always parses
+            output.update(response_mime_type="application/json", response_schema=response_schema)
+        cached = self._prompt_caches.get(key)
+        if cached and cached[1] > time.monotonic():
+            return types.GenerateContentConfig(cached_content=cached[0], **output)
+        if PROMPT_CACHE_ENABLED and (key not in self._prompt_caches or cached):
+            # Mark as pending so concurrent requests don't all create the same cache
+            self._prompt_caches[key] = None
+            task = asyncio.create_task(self._create_prompt_cache(key, model, system_instruction))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        return types.GenerateContentConfig(system_instruction=system_instruction, **output)
+    
+    async def _generate(self, key: tuple, model: str, prompt: str, system_instruction: str, response_schema: Optional[type] = None, stream: bool = False) -> Any:
+        """Call Gemini for an endpoint, failing fast while Gemini itself keeps failing"""
+        self._breaker.before_call()
+        try:
+            response = await self._generate_once(key, model, prompt, system_instruction, response_schema, stream)
+        except Exception as e:
+            self._record_outcome(e)
+            raise
+        if stream:
+            # A stream can still fail after it opens, so it's only judged once fully read
+            return self._guard_stream(response)
+        self._record_outcome()
+        return response
+    
+    async def _guard_stream(self, stream: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Pass a Gemini stream through, counting a mid-stream failure against the breaker"""
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            self._record_outcome(e)
+            raise
+        self._record_outcome()
+    
+    def _record_outcome(self, error: Optional[Exception] = None):
+        """Tell the breaker how a finished Gemini call went"""
+        # Retries are exhausted by now; only outages and quota exhaustion count against
+        # Gemini, a 4xx for one bad request still proves it's answering
+        if isinstance(error, (errors.ServerError, httpx.TransportError)) or (isinstance(error, errors.ClientError) and error.code == 429):
+            self._breaker.record_failure()
+        else:
+            self._breaker.record_success()
+    
+    async def _generate_once(self, key: tuple, model: str, prompt: str, system_instruction: str, response_schema: Optional[type] = None, stream: bool = False) -> Any:
+        """Make the Gemini call, re-sending the instructions inline if its prompt cache is gone"""
+        models = self._get_client().aio.models
+        call = models.generate_content_stream if stream else models.generate_content
+        config = self._instruction_config(key, model, system_instruction, response_schema)
+        # Rough count (~4 characters per token) plus the most the reply can use
+        await self._throttle((len(prompt) + len(system_instruction)) // 4 + GENERATION_SETTINGS[key[0]][0] + THINKING_BUDGET)
+        try:
+            return await call(model=model, contents=prompt, config=config)
+        except errors.ClientError as e:
+            if not config.cached_content or e.code not in (403, 404):
+                raise
+            # Expired or deleted server-side: forget it (a fresh one is created in the background) and retry inline
+            logger.debug("Prompt cache for %s unavailable, retrying inline: %s", key, e)
+            self._prompt_caches.pop(key, None)
+            config = self._instruction_config(key, model, system_instruction, response_schema)
+            return await call(model=model, contents=prompt, config=config)
+    
+    async def _throttle(self, tokens: int):
+        """Wait for quota before a call instead of letting a burst turn into 429s"""
+        if self._request_limiter:
+            await self._request_limiter.acquire()
+        if self._token_limiter:
+            await self._token_limiter.acquire(tokens)
+    
+    async def _create_prompt_cache(self, key: tuple, model: str, system_instruction: str):
+        """Upload the static instructions as a cached content entry"""
+        try:
+            cache = await self._get_client().aio.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    ttl=f"{PROMPT_CACHE_TTL}s"
+                )
+            )
+            # Stop using the entry a minute early so requests never race its expiry
+            self._prompt_caches[key] = (cache.name, time.monotonic() + PROMPT_CACHE_TTL - 60)
+        except Exception as e:
+            # Usually the prompt is below the model's minimum cacheable size; keep sending it inline
+            logger.debug("Prompt cache not created for %s: %s", key, e)
+    
+    async def _generate_scenario_json(self, key: tuple, prompt: str, system_instruction: str, response_schema: type) -> Dict[str, Any]:
+        """Draft a scenario on the fast model, regenerating on the fallback model if the draft is unusable"""
+        response = await self._generate(key, self.model, prompt, system_instruction, response_schema)
+        try:
+            data = orjson.loads(response.text)
+            if not self.fallback_model or _scenario_is_usable(data):
+                return data
+        except (orjson.JSONDecodeError, TypeError):
+            # Truncated or empty output (e.g. the token cap was hit)
+            if not self.fallback_model:
+                raise
+        logger.info("🔁 Draft %s failed validation, regenerating with %s", key[0], self.fallback_model)
+        # Separate key: a prompt cache is tied to the model it was created for
+        response = await self._generate(key + (self.fallback_model,), self.fallback_model, prompt, system_instruction, response_schema)
+        return orjson.loads(response.text)
+    
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """Embed text for the semantic cache; None disables the cache for this call"""
+        if not SEMANTIC_CACHE_ENABLED:
+            return None
+        try:
+            # Same guards as generation: embeddings draw on the same key and outages
+            self._breaker.before_call()
+            await self._throttle(len(text) // 4)
+            result = await self._get_client().aio.models.embed_content(
+                model=EMBED_MODEL,
+                contents=text,
+                config=types.EmbedContentConfig(output_dimensionality=768)
+            )
+        except Exception as e:
+            if not isinstance(e, CircuitOpenError):
+                self._record_outcome(e)
+            # A failed lookup just means a normal Gemini call
+            logger.debug("Embedding for semantic cache failed: %s", e)
+            return None
+        self._record_outcome()
+        return result.embeddings[0].values
+    
+    def _start_embedding(self, text: str) -> Optional["asyncio.Task"]:
+        """Embed text alongside the Gemini call; callers cancel the task once it's not needed"""
+        if not SEMANTIC_CACHE_ENABLED:
+            return None
+        task = asyncio.create_task(self._embed(text))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    async def _semantic_lookup(self, cache: SemanticCache, bucket: Any, text: str, use_cache: bool) -> Tuple[Any, Optional["asyncio.Task"]]:
+        """Look text up in a semantic cache; returns (cached value or None, embedding task or None)
+
+        Most requests are new, so the embedding overlaps the Gemini call and is only
+        awaited up front when the bucket holds something to compare it with.
+        """
+        if not use_cache:
+            # A forced fresh answer neither reads nor feeds the cache, so skip the paid embedding
+            return None, None
+        embedding = self._start_embedding(text)
+        if embedding and bucket in cache:
+            vector = await embedding
+            if vector is not None:
+                return cache.lookup(bucket, vector), embedding
+        return None, embedding
+    
+    async def _semantic_remember(self, cache: SemanticCache, bucket: Any, embedding: Optional["asyncio.Task"], value: Any):
+        """Store a freshly generated value under its request's embedding"""
+        if embedding is None:
+            return
+        vector = await embedding
+        if vector is not None and value:
+            cache.add(bucket, vector, value)
+    
+    async def generate_question(self, grade_level: str, subject: str, learning_outcomes: str, concepts: str, language: str = "english", use_cache: bool = True) -> Dict[str, Any]:
+        """Generate a practice question based on learning outcomes and concepts"""
+        
+        # Grade and subject must match exactly; only the free-text fields are compared by meaning
+        cache_bucket = ("question", grade_level, subject, language)
+        cached, embedding = await self._semantic_lookup(self._semantic_cache, cache_bucket, f"{learning_outcomes}\n{concepts}", use_cache)
+        if cached is not None:
+            logger.info("♻️ Semantic cache hit for question generation")
+            return cached
+        
+        prompt = _localized(QUESTION_PROMPTS, language).format(
+            grade_level=grade_level,
+            subject=subject,
+            learning_outcomes=learning_outcomes,
+            concepts=concepts
+        )
+        
+        try:
+            logger.info("🔄 Calling Gemini API for question generation...")
+            response = await self._generate(("question", language), self.chat_model, prompt, _localized(QUESTION_INSTRUCTIONS, language), QuestionOut)
+            logger.info("✅ Gemini API response received")
             
-            Return ONLY valid JSON, no other text or markdown formatting.
-            """
+            question_data = orjson.loads(response.text)
+            await self._semantic_remember(self._semantic_cache, cache_bucket, embedding, question_data)
+        finally:
+            # Don't leave the embedding running after a failed call
+            if embedding:
+                embedding.cancel()
+        return question_data
+    
+    async def generate_scenario(self, grade_level: str, subject: str, learning_outcomes: str, concepts: str, question: Optional[str], persona: StudentPersona, language: str = "english", use_cache: bool = True) -> Dict[str, Any]:
+        """Generate a complete teaching scenario with student profile and misconceptions"""
+        
+        if not question:
+            raise ValueError("Question is required for scenario generation")
+        
+        cache_bucket = ("scenario", grade_level, subject, question, persona, language)
+        cached, embedding = await self._semantic_lookup(self._semantic_cache, cache_bucket, f"{learning_outcomes}\n{concepts}", use_cache)
+        if cached is not None:
+            logger.info("♻️ Semantic cache hit for scenario generation")
+            return cached
+        
+        prompt = _localized(SCENARIO_PROMPTS, language).format(
+            grade_level=grade_level,
+            subject=subject,
+            learning_outcomes=learning_outcomes,
+            concepts=concepts,
+            question=question,
+            persona=persona
+        )
+        
+        try:
+            logger.info("🔄 Calling Gemini API for scenario generation with question...")
+            scenario_data = await self._generate_scenario_json(("scenario", language), prompt, _localized(SCENARIO_INSTRUCTIONS, language), ScenarioOut)
+            logger.info("✅ Gemini API response received")
+            
+            # The persona and question are inputs, so they're attached here rather than generated
+            scenario_data["persona"] = persona.model_dump()
+            scenario_data["practiceQuestion"] = question
+            await self._semantic_remember(self._semantic_cache, cache_bucket, embedding, scenario_data)
+        finally:
+            if embedding:
+                embedding.cancel()
+        return scenario_data
+    
+    async def generate_session(self, grade_level: str, subject: str, learning_outcomes: str, concepts: str, persona: StudentPersona, language: str = "english") -> Dict[str, Any]:
+        """Generate the practice question and the student scenario in a single Gemini call"""
+        
+        prompt = _localized(SESSION_PROMPTS, language).format(
+            grade_level=grade_level,
+            subject=subject,
+            learning_outcomes=learning_outcomes,
+            concepts=concepts,
+            persona=persona
+        )
+        
+        logger.info("🔄 Calling Gemini API for full session generation...")
+        session_data = await self._generate_scenario_json(("session", language), prompt, _localized(SESSION_INSTRUCTIONS, language), SessionOut)
+        logger.info("✅ Gemini API response received")
+        
+        # Same shape as /api/generate-scenario, so the result can be used as the scenario directly
+        session_data["persona"] = persona.model_dump()
+        session_data["practiceQuestion"] = session_data["question"]
+        return session_data
+    
+    def _build_student_response_prompt(self, scenario: Scenario, teacher_message: str, chat_history: List[ChatMessage], language: str = "english") -> Tuple[str, str]:
+        """Build the (system instruction, prompt) pair for the student's next reply"""
+        
+        student = scenario.student
+        misconception = student.actualMisconception
+        persona = scenario.persona
+        practice_question = scenario.practiceQuestion
+        
+        # Build context from the last 6 messages of chat history, trimming any long ones
+        context = "".join(f"{msg.sender.title()}: {_clip(msg.message)}\n" for msg in chat_history[-CONTEXT_MESSAGES:])
+        
+        prompt = _localized(STUDENT_PROMPTS, language).format(
+            student_name=student.name,
+            performance_level=student.performanceLevel,
+            topic=scenario.topic,
+            background=student.background,
+            misconception=misconception,
+            practice_question=practice_question,
+            persona_guidance=_persona_guidance(persona, language),
+            context=context,
+            teacher_message=teacher_message,
+            difficulty=scenario.difficulty
+        )
+        
+        return _localized(STUDENT_INSTRUCTIONS, language), prompt
+    
+    async def _lookup_student_reply(self, scenario: Scenario, teacher_message: str, chat_history: List[ChatMessage], language: str, use_cache: bool) -> Tuple[Any, Optional[str], Optional["asyncio.Task"]]:
+        """Check the semantic cache for a paraphrase of this teacher turn
+
+        Returns (bucket, cached reply or None, embedding task or None). A reply is only reused for
+        the same scenario at the same point in the chat, since the student sees the recent turns.
+        """
+        cache_bucket = ("student", hashlib.sha256(orjson.dumps(
+            [scenario.model_dump(), [msg.model_dump() for msg in chat_history[-CONTEXT_MESSAGES:]], language],
+            option=orjson.OPT_SORT_KEYS
+        )).digest())
+        cached, embedding = await self._semantic_lookup(self._reply_cache, cache_bucket, teacher_message, use_cache)
+        if cached is not None:
+            logger.info("♻️ Semantic cache hit for student response")
+        return cache_bucket, cached, embedding
+    
+    async def generate_student_response(self, scenario: Scenario, teacher_message: str, chat_history: List[ChatMessage], language: str = "english", use_cache: bool = True) -> str:
+        """Generate student response based on their misconception and persona"""
+        
+        cache_bucket, cached, embedding = await self._lookup_student_reply(scenario, teacher_message, chat_history, language, use_cache)
+        if cached is not None:
+            return cached
+        
+        instructions, prompt = self._build_student_response_prompt(scenario, teacher_message, chat_history, language)
+        
+        try:
+            logger.info("🔄 Calling Gemini API for reasoned student response...")
+            response = await self._generate(("student", language), self.chat_model, prompt, instructions)
+            logger.info("✅ Gemini API response received")
+            
+            reply = response.text.strip()
+            await self._semantic_remember(self._reply_cache, cache_bucket, embedding, reply)
+        finally:
+            # Don't leave the embedding running after a failed call
+            if embedding:
+                embedding.cancel()
+        return reply
+    
+    async def stream_student_response(self, scenario: Scenario, teacher_message: str, chat_history: List[ChatMessage], language: str = "english", use_cache: bool = True) -> AsyncIterator[str]:
+        """Yield the student's reply text as Gemini generates it"""
+        
+        cache_bucket, cached, embedding = await self._lookup_student_reply(scenario, teacher_message, chat_history, language, use_cache)
+        if cached is not None:
+            yield cached
+            return
+        
+        instructions, prompt = self._build_student_response_prompt(scenario, teacher_message, chat_history, language)
         
-        prompt = language_prefix + evaluation_template.format(
-            actual_misconception=scenario['student']['actualMisconception'],
-            teacher_diagnosis=scenario['misconceptionOptions'][selected_misconception],
+        try:
+            logger.info("🔄 Streaming Gemini API student response...")
+            stream = await self._generate(("student", language), self.chat_model, prompt, instructions, stream=True)
+            parts = []
+            async for chunk in stream:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            await self._semantic_remember(self._reply_cache, cache_bucket, embedding, "".join(parts).strip())
+        finally:
+            # Also runs when the client disconnects mid-stream and the generator is closed
+            if embedding:
+                embedding.cancel()
+    
+    async def evaluate_session(self, scenario: Scenario, selected_misconception: int, intervention: str, chat_history: List[ChatMessage], selected_strategy: Optional[str] = None, language: str = "english") -> Dict[str, Any]:
+        """Evaluate the teacher's diagnosis and intervention"""
+        
+        correct_index = scenario.correctMisconceptionIndex
+        correct_diagnosis = selected_misconception == correct_index
+        
+        # Build evaluation prompt
+        chat_text = "".join(f"{msg.sender.title()}: {msg.message}\n" for msg in chat_history)
+        
+        strategy_context = f"Selected Teaching Strategy: {selected_strategy}" if selected_strategy else "No specific strategy selected"
+        
+        correct_diagnosis_text = _localized(DIAGNOSIS_LABELS, language)[correct_diagnosis]
+        
+        prompt = _localized(EVALUATION_PROMPTS, language).format(
+            actual_misconception=scenario.student.actualMisconception,
+            teacher_diagnosis=scenario.misconceptionOptions[selected_misconception],
             correct_diagnosis_text=correct_diagnosis_text,
             intervention=intervention,
             strategy_context=strategy_context,
-            chat_text=chat_text,
-            correct_diagnosis_json=str(correct_diagnosis).lower()
+            chat_text=chat_text
         )
         
-        print(f"🔄 Calling Gemini API for session evaluation...")
-        if self.model is None:
-            raise HTTPException(status_code=503, detail="AI service unavailable")
-        response = self.model.generate_content(prompt)
-        print(f"✅ Gemini API response received")
+        logger.info("🔄 Calling Gemini API for session evaluation...")
+        response = await self._generate(("evaluation", language), self.eval_model, prompt, _localized(EVALUATION_INSTRUCTIONS, language), EvaluationOut)
+        logger.info("✅ Gemini API response received")
         
-        # Clean and parse the JSON response
-        clean_text = self._clean_json_response(response.text)
-        evaluation = json.loads(clean_text)
+        evaluation = orjson.loads(response.text)
+        # The diagnosis check is computed locally, so it isn't part of the response schema
+        evaluation["correctDiagnosis"] = correct_diagnosis
         return evaluation
 
 # Initialize services
 gemini_service = GeminiService()
 
+# Availability can't change at runtime, so /health reports these precomputed values
+API_KEY_STATUS = "available" if API_KEY else "missing"
+AI_READY = gemini_service.available
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag for a fixed response body"""
+    return f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+def conditional_response(request: Request, body: bytes, etag: str, media_type: str, cache_control: str) -> Response:
+    """Serve a fixed body, or a bodyless 304 when the client already holds this ETag"""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+# Liveness probes and edges may reuse /health and /test for a few seconds
+PROBE_CACHE_CONTROL = "public, max-age=5"
+
+# The health payload never changes after startup: serialize it once and let
+# pollers revalidate with If-None-Match instead of re-downloading it
+HEALTH_BODY = orjson.dumps({
+    "status": "healthy",
+    "version": "2.0",
+    "api_key": API_KEY_STATUS,
+    "ai_ready": AI_READY,
+    "features": ["Teaching Simulation", "AI Student Responses", "Session Evaluation"]
+})
+HEALTH_ETAG = make_etag(HEALTH_BODY)
+
+TEST_BODY = orjson.dumps({
+    "message": "TeachWise API is running!",
+    "timestamp": "2024-01-01T00:00:00Z",
+    "environment": "production"
+})
+TEST_ETAG = make_etag(TEST_BODY)
+
+# Every AI route answers with the same body when no key is configured, so serialize it once
+_AI_UNAVAILABLE_BODY = orjson.dumps({
+    "error": "AI service unavailable - GOOGLE_API_KEY environment variable not set",
+    "help": "Set GOOGLE_API_KEY (or GEMINI_API_KEY) in your .env file or Vercel project settings > Environment Variables"
+})
+
+def ai_unavailable_response() -> Response:
+    """503 response shared by the AI routes when Gemini isn't configured"""
+    return Response(content=_AI_UNAVAILABLE_BODY, status_code=503, media_type="application/json")
+
+class AIUnavailableError(Exception):
+    """Raised by require_ai when Gemini isn't configured"""
+
+@app.exception_handler(AIUnavailableError)
+async def ai_unavailable_handler(request: Request, exc: AIUnavailableError):
+    return ai_unavailable_response()
+
+def upstream_error(exc: Exception) -> Optional[Tuple[int, str]]:
+    """(status, detail) for failures that come from Gemini rather than from this app"""
+    if isinstance(exc, CircuitOpenError):
+        return 503, str(exc)
+    if isinstance(exc, errors.APIError):
+        if exc.code == 429:
+            return 503, "Gemini API quota exhausted, please try again shortly"
+        return 502, f"Gemini API error {exc.code}: {exc.message}"
+    if isinstance(exc, httpx.TimeoutException):
+        return 504, "Gemini API timed out"
+    if isinstance(exc, httpx.TransportError):
+        return 502, "Could not reach the Gemini API"
+    return None
+
+async def upstream_error_handler(request: Request, exc: Exception):
+    status_code, detail = upstream_error(exc)
+    logger.warning("⚠️ Gemini call for %s failed: %s", request.url.path, exc)
+    return ORJSONResponse({"detail": detail}, status_code=status_code)
+
+for _upstream_exc in (CircuitOpenError, errors.APIError, httpx.TransportError):
+    app.add_exception_handler(_upstream_exc, upstream_error_handler)
+
+INTERNAL_ERROR_DETAIL = "Internal server error"
+
+@app.exception_handler(Exception)
+async def internal_error_handler(request: Request, exc: Exception):
+    # Starlette re-raises after this, so the server logs the traceback exactly once.
+    # This handler runs outside CORSMiddleware, so add its header here or browsers
+    # report a CORS failure instead of the 500
+    headers = {}
+    origin = request.headers.get("origin")
+    if origin and "*" in CORS_ORIGINS:
+        headers["Access-Control-Allow-Origin"] = "*"
+    elif origin in CORS_ORIGINS:
+        headers.update({"Access-Control-Allow-Origin": origin, "Vary": "Origin"})
+    return ORJSONResponse({"detail": INTERNAL_ERROR_DETAIL}, status_code=500, headers=headers)
+
+def require_ai():
+    """Dependency guarding the AI routes before their body is even read"""
+    if not gemini_service.available:
+        raise AIUnavailableError()
+
+# Resolve the frontend relative to this file so the app works from any cwd (e.g. Vercel)
+INDEX_HTML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html")
+INDEX_HTML_EXISTS = os.path.isfile(INDEX_HTML_PATH)
+_FRONTEND_MISSING_HTML = b"<h1>TeachWise</h1><p>Frontend not found</p>"
+INDEX_HTML_CACHE_CONTROL = "public, max-age=60"
+
+def _read_index_html() -> Tuple[bytes, str, int]:
+    """Read the frontend once, returning its bytes, ETag and mtime"""
+    if not INDEX_HTML_EXISTS:
+        return _FRONTEND_MISSING_HTML, make_etag(_FRONTEND_MISSING_HTML), 0
+    with open(INDEX_HTML_PATH, "rb") as f:
+        body = f.read()
+    return body, make_etag(body), os.stat(INDEX_HTML_PATH).st_mtime_ns
+
+_index_html, _index_html_etag, _index_html_mtime = _read_index_html()
+
+def get_index_html() -> Tuple[bytes, str]:
+    """Return the frontend bytes and ETag held in memory since startup
+
+    Only with DEBUG set is index.html stat'ed per request, so edits show up while developing.
+    """
+    global _index_html, _index_html_etag, _index_html_mtime
+    if DEBUG and INDEX_HTML_EXISTS and os.stat(INDEX_HTML_PATH).st_mtime_ns != _index_html_mtime:
+        _index_html, _index_html_etag, _index_html_mtime = _read_index_html()
+    return _index_html, _index_html_etag
+
+# Exact-match tier in front of the semantic cache, holding encoded response bodies.
+# Questions are keyed on (gradeLevel, subject, learningOutcomes, concepts, language);
+# scenarios also on the question and persona.
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 3600
+_question_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+_scenario_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+# Chat replies and evaluations are keyed on a digest of the whole validated request,
+# so a resent turn (double click, retry, demo replay) skips Gemini entirely
+_student_cache = TTLCache(1024, RESPONSE_CACHE_TTL)
+_evaluation_cache = TTLCache(1024, RESPONSE_CACHE_TTL)
+# Identical requests already in flight (a classroom hitting "generate" on the same
+# lesson, a resent chat turn) share one Gemini call
+_inflight = SingleFlight()
+
+def request_digest(request: BaseModel) -> bytes:
+    """SHA-256 of the request's validated fields in sorted-key JSON (unknown fields are already dropped)"""
+    return hashlib.sha256(orjson.dumps(request.model_dump(), option=orjson.OPT_SORT_KEYS)).digest()
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
 # API Routes
 @app.get("/")
-async def serve_frontend():
+@app.get("/index.html")
+async def serve_frontend(request: Request):
     """Serve the main frontend"""
-    return FileResponse("index.html")
+    body, etag = get_index_html()
+    return conditional_response(request, body, etag, "text/html", INDEX_HTML_CACHE_CONTROL)
+
+@app.post("/api/generate-question", dependencies=[Depends(require_ai)])
+async def generate_question(request: QuestionGenerationRequest = json_body(QuestionGenerationRequest), nocache: bool = False):
+    """Generate a practice question based on learning outcomes and concepts
 
-@app.post("/api/generate-question")
-async def generate_question(request: QuestionGenerationRequest):
-    """Generate a practice question based on learning outcomes and concepts"""
-    try:
-        question_data = gemini_service.generate_question(
+    Identical inputs are answered for an hour from an in-memory LRU of serialized responses,
+    near-duplicates from the semantic cache; pass ?nocache=1 to force a fresh question.
+    """
+    key = (request.gradeLevel, request.subject, request.learningOutcomes, request.concepts, request.language)
+    if not nocache:
+        cached = _question_cache.get(key)
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+    
+    async def generate() -> bytes:
+        question_data = await gemini_service.generate_question(
             request.gradeLevel,
             request.subject,
             request.learningOutcomes,
             request.concepts,
-            request.language
+            request.language,
+            use_cache=not nocache
         )
-        return question_data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate question: {str(e)}")
-
-@app.post("/api/generate-scenario")
-async def generate_scenario(request: ScenarioRequest):
-    """Generate a new teaching scenario"""
-    try:
-        if not request.question:
-            raise HTTPException(status_code=400, detail="Question is required for scenario generation")
-        
-        scenario = gemini_service.generate_scenario(
+        # Cache the encoded bytes so repeat hits skip serialization as well
+        body = orjson.dumps(question_data)
+        _question_cache.set(key, body)
+        return body
+    
+    body = await generate() if nocache else await _inflight.do(("question",) + key, generate)
+    return Response(content=body, media_type="application/json")
+
+@app.post("/api/generate-scenario", dependencies=[Depends(require_ai)])
+async def generate_scenario(request: ScenarioRequest = json_body(ScenarioRequest), nocache: bool = False):
+    """Generate a new teaching scenario (pass ?nocache=1 to skip both response caches)"""
+    key = (request.gradeLevel, request.subject, request.learningOutcomes, request.concepts, request.question,
+           request.studentPersona, request.language)
+    if not nocache:
+        cached = _scenario_cache.get(key)
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+    
+    if not request.question:
+        raise HTTPException(status_code=400, detail="Question is required for scenario generation")
+    
+    async def generate() -> bytes:
+        scenario = await gemini_service.generate_scenario(
             request.gradeLevel,
             request.subject,
             request.learningOutcomes,
             request.concepts,
             request.question,
             request.studentPersona,
-            request.language
-        )
-        return scenario
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate scenario: {str(e)}")
-
-@app.post("/api/student-response")
-async def get_student_response(request: StudentResponseRequest):
-    """Get AI student response to teacher's question"""
-    try:
-        response = gemini_service.generate_student_response(
-            request.scenario,
-            request.teacherMessage,
-            request.chatHistory,
-            request.language
+            request.language,
+            use_cache=not nocache
         )
-        return {"response": response}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate student response: {str(e)}")
-
-@app.post("/api/evaluate-session")
-async def evaluate_session(request: EvaluationRequest):
-    """Evaluate the teacher's diagnosis and intervention"""
-    try:
-        evaluation = gemini_service.evaluate_session(
+        body = orjson.dumps(scenario)
+        _scenario_cache.set(key, body)
+        return body
+    
+    body = await generate() if nocache else await _inflight.do(("scenario",) + key, generate)
+    return Response(content=body, media_type="application/json")
+
+@app.post("/api/start-session", dependencies=[Depends(require_ai)])
+async def start_session(request: SessionRequest = json_body(SessionRequest)):
+    """Generate a practice question and its student scenario in one round-trip"""
+    session = await gemini_service.generate_session(
+        request.gradeLevel,
+        request.subject,
+        request.learningOutcomes,
+        request.concepts,
+        request.studentPersona,
+        request.language
+    )
+    return ORJSONResponse(session)
+
+@app.post("/api/student-response", dependencies=[Depends(require_ai)])
+async def get_student_response(request: StudentResponseRequest = json_body(StudentResponseRequest), nocache: bool = False):
+    """Get AI student response to teacher's question (pass ?nocache=1 for a fresh reply)"""
+    key = request_digest(request)
+    response = None if nocache else _student_cache.get(key)
+    if response is None:
+        async def generate() -> str:
+            reply = await gemini_service.generate_student_response(
+                request.scenario,
+                request.teacherMessage,
+                request.chatHistory,
+                request.language,
+                use_cache=not nocache
+            )
+            _student_cache.set(key, reply)
+            return reply
+        
+        response = await generate() if nocache else await _inflight.do(("student", key), generate)
+    return ORJSONResponse({"response": response})
+
+@app.post("/api/student-response/stream", dependencies=[Depends(require_ai)])
+async def stream_student_response(request: StudentResponseRequest = json_body(StudentResponseRequest), nocache: bool = False):
+    """Stream the AI student's response as server-sent events while Gemini generates it
+
+    Each chunk is a `data: {"delta": ...}` event; the stream ends with an `event: done`
+    carrying the full reply, or an `event: error` if Gemini fails partway through.
+    A reply already cached by either student-response endpoint arrives as one delta.
+    """
+    key = request_digest(request)
+    cached = None if nocache else _student_cache.get(key)
+    
+    async def events():
+        if cached is not None:
+            yield b"data: " + orjson.dumps({"delta": cached}) + b"\n\n"
+            yield b"event: done\ndata: " + orjson.dumps({"response": cached}) + b"\n\n"
+            return
+        parts = []
+        try:
+            async for delta in gemini_service.stream_student_response(
+                request.scenario,
+                request.teacherMessage,
+                request.chatHistory,
+                request.language,
+                use_cache=not nocache
+            ):
+                parts.append(delta)
+                yield b"data: " + orjson.dumps({"delta": delta}) + b"\n\n"
+        except Exception as e:
+            # Headers are already sent, so the failure has to travel in-band
+            failure = upstream_error(e)
+            logger.error("❌ Student response stream failed: %s", e, exc_info=failure is None)
+            yield b"event: error\ndata: " + orjson.dumps({"detail": failure[1] if failure else INTERNAL_ERROR_DETAIL}) + b"\n\n"
+            return
+        response = "".join(parts).strip()
+        _student_cache.set(key, response)
+        yield b"event: done\ndata: " + orjson.dumps({"response": response}) + b"\n\n"
+    
+    # Keep proxies (and Vercel's edge) from buffering the stream or caching it
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/api/evaluate-session", dependencies=[Depends(require_ai)])
+async def evaluate_session(request: EvaluationRequest = json_body(EvaluationRequest), nocache: bool = False):
+    """Evaluate the teacher's diagnosis and intervention (pass ?nocache=1 to re-grade)"""
+    key = request_digest(request)
+    if not nocache:
+        cached = _evaluation_cache.get(key)
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+    
+    async def generate() -> bytes:
+        evaluation = await gemini_service.evaluate_session(
             request.scenario,
             request.selectedMisconception,
             request.intervention,
@@ -729,30 +1668,33 @@ async def evaluate_session(request: EvaluationRequest):
             request.selectedStrategy,
             request.language
         )
-        return evaluation
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to evaluate session: {str(e)}")
+        body = orjson.dumps(evaluation)
+        _evaluation_cache.set(key, body)
+        return body
+    
+    # A double-clicked submit grades once
+    body = await generate() if nocache else await _inflight.do(("evaluation", key), generate)
+    return Response(content=body, media_type="application/json")
 
 @app.get("/health")
-async def health_check():
+async def health_check(request: Request):
     """Health check endpoint"""
-    api_key_status = "available" if os.getenv("GOOGLE_API_KEY") else "missing"
-    return {
-        "status": "healthy",
-        "version": "2.0",
-        "api_key": api_key_status,
-        "features": ["Teaching Simulation", "AI Student Responses", "Session Evaluation"]
-    }
+    return conditional_response(request, HEALTH_BODY, HEALTH_ETAG, "application/json", PROBE_CACHE_CONTROL)
 
 @app.get("/test")
-async def test_endpoint():
+async def test_endpoint(request: Request):
     """Test endpoint to verify deployment"""
-    return {
-        "message": "TeachWise API is running!",
-        "timestamp": "2024-01-01T00:00:00Z",
-        "environment": "production"
-    }
+    return conditional_response(request, TEST_BODY, TEST_ETAG, "application/json", PROBE_CACHE_CONTROL)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # One worker per core so Gemini I/O overlaps across processes; uvicorn picks
+    # uvloop and httptools automatically when installed (uvicorn[standard])
+    uvicorn.run(
+        "simple_app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        # A synchronous access-log line per request; only worth it when debugging
+        access_log=DEBUG
+    ) 
\ No newline at end of file
@@ -11,6 +11,8 @@ from dotenv import load_dotenv
 def main():
     # Load environment variables from .env file
     load_dotenv()
+    # APP_ENV=prod runs one worker per core without the reloader or per-request logging
+    production = os.getenv("APP_ENV", "").lower() in ("prod", "production")
     
     # Check for Google API key
     if not os.getenv("GOOGLE_API_KEY"):
@@ -19,23 +21,29 @@ def main():
         print("GOOGLE_API_KEY='your_api_key_here'")
         print("")
         
-        # Ask user if they want to continue anyway
-        response = input("Continue anyway? (y/n): ")
-        if response.lower() != 'y':
-            sys.exit(1)
+        # Ask user if they want to continue anyway (nobody is there to answer in production)
+        if not production:
+            response = input("Continue anyway? (y/n): ")
+            if response.lower() != 'y':
+                sys.exit(1)
     
     print("🚀 Starting TeachWise - AI Teaching Simulator")
     print("📖 Open your browser to: http://localhost:8000")
     print("⌨️  Press Ctrl+C to stop the server")
     print("")
     
-    # Run the app
+    # Run the app. The reloader only supports a single process; uvicorn[standard]
+    # picks uvloop and httptools automatically when they're installed.
+    if production:
+        options = {"workers": int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)), "access_log": False, "log_level": "warning"}
+    else:
+        options = {"reload": True}
     try:
         uvicorn.run(
             "simple_app:app",
             host="0.0.0.0",
             port=8000,
-            reload=True
+            **options
         )
     except KeyboardInterrupt:
         print("\n👋 TeachWise stopped. Thanks for using the app!")
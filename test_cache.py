@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import cache
+from cache import SingleFlight, TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_ttl_cache_returns_live_values(clock):
+    entries = TTLCache(ttl=60)
+    assert entries.get("a") is None
+    entries.set("a", 1)
+    clock.now += 59
+    assert entries.get("a") == 1
+
+
+def test_ttl_cache_expires_entries(clock):
+    entries = TTLCache(ttl=60)
+    entries.set("a", 1)
+    clock.now += 60
+    assert entries.get("a") is None
+    # The expired entry is dropped on lookup, not left taking up a slot
+    assert len(entries) == 0
+
+
+def test_ttl_cache_per_entry_ttl(clock):
+    entries = TTLCache(ttl=60)
+    entries.set("short", 1, ttl=5)
+    entries.set("long", 2)
+    clock.now += 5
+    assert entries.get("short") is None
+    assert entries.get("long") == 2
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    entries = TTLCache(maxsize=2)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    entries.get("a")
+    entries.set("c", 3)
+    assert entries.get("b") is None
+    assert entries.get("a") == 1
+    assert entries.get("c") == 3
+    assert len(entries) == 2
+
+
+def test_ttl_cache_set_refreshes_existing_key(clock):
+    entries = TTLCache(maxsize=2, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    clock.now += 30
+    entries.set("a", 10)
+    entries.set("c", 3)
+    assert entries.get("b") is None
+    clock.now += 45
+    assert entries.get("a") == 10
+
+
+def test_ttl_cache_clear(clock):
+    entries = TTLCache()
+    entries.set("a", 1)
+    entries.clear()
+    assert len(entries) == 0
+    assert entries.get("a") is None
+
+
+def test_single_flight_shares_one_call():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", factory) for _ in range(5)))
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert results == ["value"] * 5
+    assert calls == [1]
+    assert len(flight) == 0
+
+
+def test_single_flight_shares_failures_then_retries():
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", failing) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert len(flight) == 0
+        # A finished failure isn't cached: the next call starts fresh
+        with pytest.raises(RuntimeError):
+            await flight.do("key", failing)
+
+    asyncio.run(run())
+    assert calls == [1, 1]
+
+
+def test_single_flight_survives_a_cancelled_waiter():
+    async def factory():
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("key", factory))
+        second = asyncio.ensure_future(flight.do("key", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert asyncio.run(run()) == ("value", True)
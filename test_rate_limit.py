@@ -0,0 +1,149 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import rate_limit
+from rate_limit import CircuitBreaker, CircuitOpenError, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        await _real_sleep(0)
+
+
+_real_sleep = asyncio.sleep
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(rate_limit, "asyncio", SimpleNamespace(Lock=asyncio.Lock, sleep=clock.sleep))
+    return clock
+
+
+def test_bucket_starts_full(clock):
+    bucket = TokenBucket(10)
+    asyncio.run(bucket.acquire(10))
+    assert clock.sleeps == []
+
+
+def test_bucket_waits_for_refill(clock):
+    async def run():
+        bucket = TokenBucket(60, period=60)
+        await bucket.acquire(60)
+        await bucket.acquire(2)
+
+    asyncio.run(run())
+    # 1 token per second, so 2 tokens take 2 seconds
+    assert sum(clock.sleeps) == pytest.approx(2.0)
+
+
+def test_bucket_refill_is_capped_at_capacity(clock):
+    async def run():
+        bucket = TokenBucket(10, period=10)
+        await bucket.acquire(10)
+        clock.now += 1000
+        await bucket.acquire(10)
+        assert clock.sleeps == []
+        await bucket.acquire(1)
+
+    asyncio.run(run())
+    assert sum(clock.sleeps) == pytest.approx(1.0)
+
+
+def test_bucket_caps_oversized_requests(clock):
+    async def run():
+        bucket = TokenBucket(10)
+        await bucket.acquire(50)
+        return bucket
+
+    bucket = asyncio.run(run())
+    assert clock.sleeps == []
+    assert bucket._tokens == pytest.approx(0)
+
+
+def test_bucket_serves_waiters_in_arrival_order(clock):
+    order = []
+
+    async def take(bucket, name, amount):
+        await bucket.acquire(amount)
+        order.append(name)
+
+    async def run():
+        bucket = TokenBucket(10, period=10)
+        await bucket.acquire(10)
+        # The small request would fit sooner, but must queue behind the big one
+        await asyncio.gather(take(bucket, "big", 5), take(bucket, "small", 1))
+
+    asyncio.run(run())
+    assert order == ["big", "small"]
+    assert sum(clock.sleeps) == pytest.approx(6.0)
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("upstream", fail_max=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError, match="upstream"):
+        breaker.before_call()
+
+
+def test_breaker_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("upstream", fail_max=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_breaker_lets_one_trial_through_after_timeout(clock):
+    breaker = CircuitBreaker("upstream", fail_max=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+    # The timer was re-armed, so a second caller still fails fast during the trial
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_breaker_trial_success_closes(clock):
+    breaker = CircuitBreaker("upstream", fail_max=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_call()
+
+
+def test_breaker_trial_failure_reopens(clock):
+    breaker = CircuitBreaker("upstream", fail_max=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.is_open
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
@@ -0,0 +1,78 @@
+import math
+
+from semantic_cache import SemanticCache
+
+
+def at_cosine(score):
+    """Unit vector whose cosine similarity with [1, 0] is score"""
+    return [score, math.sqrt(1 - score * score)]
+
+
+BASE = [1.0, 0.0]
+
+
+def test_lookup_hits_just_above_threshold():
+    entries = SemanticCache(threshold=0.92)
+    entries.add("bucket", BASE, "cached")
+    assert entries.lookup("bucket", at_cosine(0.921)) == "cached"
+
+
+def test_lookup_misses_just_below_threshold():
+    entries = SemanticCache(threshold=0.92)
+    entries.add("bucket", BASE, "cached")
+    assert entries.lookup("bucket", at_cosine(0.919)) is None
+
+
+def test_lookup_is_scale_invariant():
+    entries = SemanticCache(threshold=0.92)
+    entries.add("bucket", [10.0, 0.0], "cached")
+    assert entries.lookup("bucket", [0.5, 0.0]) == "cached"
+
+
+def test_lookup_picks_the_closest_of_several():
+    entries = SemanticCache(threshold=0.9)
+    entries.add("bucket", at_cosine(0.93), "close")
+    entries.add("bucket", at_cosine(0.99), "closest")
+    entries.add("bucket", at_cosine(0.95), "closer")
+    assert entries.lookup("bucket", BASE) == "closest"
+
+
+def test_lookup_only_searches_its_bucket():
+    entries = SemanticCache(threshold=0.92)
+    entries.add("english", BASE, "english value")
+    assert entries.lookup("chinese", BASE) is None
+
+
+def test_bucket_keeps_the_most_recent_entries():
+    entries = SemanticCache(threshold=0.99, max_per_bucket=2)
+    entries.add("bucket", [1.0, 0.0, 0.0], "first")
+    entries.add("bucket", [0.0, 1.0, 0.0], "second")
+    # A hit moves the entry to the recent end, so "second" is the one evicted next
+    assert entries.lookup("bucket", [1.0, 0.0, 0.0]) == "first"
+    entries.add("bucket", [0.0, 0.0, 1.0], "third")
+    assert entries.lookup("bucket", [0.0, 1.0, 0.0]) is None
+    assert entries.lookup("bucket", [1.0, 0.0, 0.0]) == "first"
+    assert entries.lookup("bucket", [0.0, 0.0, 1.0]) == "third"
+
+
+def test_least_recently_used_bucket_is_evicted():
+    entries = SemanticCache(threshold=0.92, max_buckets=2)
+    entries.add("a", BASE, "a")
+    entries.add("b", BASE, "b")
+    entries.lookup("a", BASE)
+    entries.add("c", BASE, "c")
+    assert "b" not in entries
+    assert entries.lookup("a", BASE) == "a"
+    assert entries.lookup("c", BASE) == "c"
+
+
+def test_contains_reports_populated_buckets():
+    entries = SemanticCache()
+    assert "bucket" not in entries
+    # A lookup on a missing bucket must not create it
+    entries.lookup("bucket", BASE)
+    assert "bucket" not in entries
+    entries.add("bucket", BASE, "cached")
+    assert "bucket" in entries
+    entries.clear()
+    assert "bucket" not in entries